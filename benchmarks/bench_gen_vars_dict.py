@@ -0,0 +1,93 @@
+"""
+gen_vars_dict单文件耗时对比：逐行index/Counter的旧实现 vs 预先计算切片计划的新实现
+
+运行方式（在仓库根目录）：
+    uv run python -m benchmarks.bench_gen_vars_dict --seconds 3600 --columns 3000
+"""
+
+import argparse
+import random
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from preprocess import gen_vars_dict, get_need_vars_from_csv
+
+
+# 旧实现，仅作为对比基准
+def legacy_gen_vars_dict(data_header, real_data, need_vars):
+    dict_data = defaultdict(lambda: defaultdict(list))
+
+    for search_header in need_vars:
+        sample_rate = Counter(data_header).get(search_header)
+        dict_data[f"{search_header}"]["rate"] = sample_rate
+
+    for line in real_data:
+        for search_header in need_vars:
+            index_start = data_header.index(search_header)
+            index_end = index_start + dict_data[f"{search_header}"]["rate"]
+            list_data = line[index_start:index_end]
+            dict_data[f"{search_header}"]["value"].append(list_data)
+
+    return dict_data
+
+
+def gen_synthetic_rows(need_vars, seconds, columns, seed=0):
+    rnd = random.Random(seed)
+    rates = {var: rnd.choice([1, 2, 4, 8, 16]) for var in need_vars}
+    rates["DATE"] = 1
+    # 其余不需要的参数，用于填充表头长度
+    filler = 0
+    while sum(rates.values()) < columns:
+        rates[f"FILLER_{filler}"] = rnd.choice([1, 2, 4, 8, 16])
+        filler += 1
+
+    names = list(rates)
+    rnd.shuffle(names)
+    header = [name for name in names for _ in range(rates[name])]
+    row = [f"{rnd.uniform(0, 100):.3f}" for _ in header]
+    rows = [list(row) for _ in range(seconds)]
+
+    return header, rows
+
+
+def best_of(func, repeat, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=int, default=3600, help="航段时长（行数）")
+    parser.add_argument("--columns", type=int, default=3000, help="表头列数")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--need-vars", default="./configs/need_vars.csv")
+    args = parser.parse_args()
+
+    need_vars = get_need_vars_from_csv(args.need_vars)
+    header, rows = gen_synthetic_rows(need_vars, args.seconds, args.columns)
+
+    # 确认两种实现的结果一致
+    legacy = legacy_gen_vars_dict(header, rows, need_vars)
+    current = gen_vars_dict(header, rows, need_vars)
+    for var in need_vars:
+        assert legacy[var]["rate"] == current[var]["rate"]
+        assert np.array_equal(np.asarray(legacy[var]["value"]), current[var]["value"])
+
+    legacy_time = best_of(legacy_gen_vars_dict, args.repeat, header, rows, need_vars)
+    current_time = best_of(gen_vars_dict, args.repeat, header, rows, need_vars)
+
+    print(f"表头列数: {len(header)}, 行数: {len(rows)}, 参数个数: {len(need_vars)}")
+    print(f"旧实现: {legacy_time:.3f}s")
+    print(f"新实现: {current_time:.3f}s")
+    print(f"加速比: {legacy_time / current_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+process端到端性能测试：用进程池处理一批zip文件，输出总耗时、各阶段统计，并与基准结果逐字节比对
+
+运行方式（在仓库根目录）：
+    # 生成合成数据并保存为基准结果
+    uv run python -m benchmarks.bench_process --files 8 --update-golden
+    # 修改代码后再次运行，检查性能和结果是否一致
+    uv run python -m benchmarks.bench_process --files 8
+"""
+
+import argparse
+import filecmp
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pathos.multiprocessing import ProcessingPool as newpool
+
+from benchmarks.synthetic_eafr import gen_flight_zips
+from preprocess import (
+    get_need_vars_from_csv,
+    init_process_worker,
+    process_zip_in_worker,
+    sort_zip_sources_by_size,
+)
+from profiling import format_stage_report
+
+
+def run_process(zip_file_s, need_vars, output_folder, output_format, jobs):
+    zip_size_s = sort_zip_sources_by_size(zip_file_s)
+    with newpool(
+        processes=jobs,
+        initializer=init_process_worker,
+        initargs=(need_vars, output_folder, output_format, True),
+    ) as p:
+        start = time.perf_counter()
+        results = list(
+            p.uimap(process_zip_in_worker, [zip_file for zip_file, _ in zip_size_s])
+        )
+        wall_time = time.perf_counter() - start
+
+    return wall_time, results
+
+
+def compare_with_golden(output_folder, golden_folder):
+    output_names = sorted(os.listdir(output_folder))
+    golden_names = sorted(os.listdir(golden_folder))
+    mismatch = sorted(set(output_names) ^ set(golden_names))
+    _, diff, errors = filecmp.cmpfiles(
+        output_folder,
+        golden_folder,
+        sorted(set(output_names) & set(golden_names)),
+        shallow=False,
+    )
+
+    return mismatch + diff + errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "-i", "--input-folder", help="待处理的zip文件夹，不指定时生成合成数据"
+    )
+    parser.add_argument("--files", type=int, default=4, help="生成的文件个数")
+    parser.add_argument("--seconds", type=int, default=3600, help="最长航段时长（行数）")
+    parser.add_argument("--columns", type=int, default=3000, help="表头列数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--output-format",
+        default="TSV",
+        choices=["TSV", "Parquet", "Feather", "NPZ"],
+    )
+    parser.add_argument("--golden-folder", default="./benchmarks/golden")
+    parser.add_argument(
+        "--update-golden", action="store_true", help="用本次结果覆盖基准结果"
+    )
+    parser.add_argument("--need-vars", default="./configs/need_vars.csv")
+    args = parser.parse_args()
+
+    need_vars = get_need_vars_from_csv(args.need_vars)
+    work_folder = tempfile.mkdtemp(prefix="bench_process_")
+    try:
+        input_folder = args.input_folder
+        if input_folder is None:
+            input_folder = os.path.join(work_folder, "input")
+            gen_flight_zips(
+                input_folder,
+                need_vars,
+                files=args.files,
+                seconds=args.seconds,
+                columns=args.columns,
+                seed=args.seed,
+            )
+        zip_file_s = glob.glob(os.path.join(input_folder, "*.zip"))
+        input_size = sum(os.path.getsize(zip_file) for zip_file in zip_file_s)
+
+        output_folder = os.path.join(work_folder, "output")
+        os.makedirs(output_folder)
+        wall_time, results = run_process(
+            zip_file_s, need_vars, output_folder, args.output_format, args.jobs
+        )
+
+        print(f"文件个数: {len(zip_file_s)}, 进程数: {args.jobs}")
+        print(
+            f"总耗时: {wall_time:.2f}s, {len(zip_file_s) / wall_time:.2f}个文件/s, "
+            f"zip {input_size / 1024 / 1024 / wall_time:.1f}MB/s"
+        )
+        for zip_file_header, error, _ in results:
+            if error is not None:
+                print(f"{zip_file_header}处理失败: {error}")
+        print(format_stage_report([stage_stats for _, _, stage_stats in results]))
+
+        golden_folder = os.path.join(args.golden_folder, args.output_format.lower())
+        if args.update_golden:
+            shutil.rmtree(golden_folder, ignore_errors=True)
+            shutil.copytree(output_folder, golden_folder)
+            print(f"已更新基准结果: {golden_folder}")
+        elif os.path.isdir(golden_folder):
+            different = compare_with_golden(output_folder, golden_folder)
+            if different:
+                print(f"与基准结果不一致的文件: {different}")
+                sys.exit(1)
+            print("与基准结果一致")
+        else:
+            print(f"没有基准结果{golden_folder}，可以加--update-golden生成")
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+生成合成的EAFR航班zip文件，用于性能测试和结果一致性检查，不含任何真实航班数据
+
+运行方式（在仓库根目录）：
+    uv run python -m benchmarks.synthetic_eafr -o ./synthetic --files 8 --seconds 3600
+"""
+
+import argparse
+import datetime
+import os
+import zipfile
+
+import numpy as np
+
+from preprocess import get_need_vars_from_csv
+from utility import DATE_FORMATS
+
+# 普通参数的采样率，高于16Hz的参数在处理时直接抽取
+LOW_RATES = (1, 2, 4, 8, 16)
+HIGH_RATES = (32, 64)
+# 重心的各位数字，必须是1Hz的整数
+COG_DIGITS = ("CG1_0_01_R", "CG1_0_1_R", "CG1_1_R", "CG1_10_R", "CG1_100_R")
+
+
+def gen_rates(need_vars, columns, high_rate_share=0.05, rng=None):
+    """
+    返回{参数名: 采样率}，需要的参数之外用填充参数把表头补齐到columns列
+    """
+    rng = rng or np.random.default_rng()
+    rates = {"DATE": 1}
+    for var in need_vars:
+        if var in rates:
+            continue
+        rates[var] = 1 if var in COG_DIGITS else int(rng.choice(LOW_RATES))
+
+    filler = 0
+    while sum(rates.values()) < columns:
+        if rng.random() < high_rate_share:
+            rate = int(rng.choice(HIGH_RATES))
+        else:
+            rate = int(rng.choice(LOW_RATES))
+        rates[f"FILLER_{filler}"] = rate
+        filler += 1
+
+    return rates
+
+
+def gen_column_values(var, rate, seconds, rng):
+    # 平滑变化的信号加少量噪声，格式与导出数据一致保留3位小数
+    sample_numbers = seconds * rate
+    if var in COG_DIGITS:
+        return rng.integers(0, 10, sample_numbers).astype(str)
+
+    t = np.arange(sample_numbers) / rate
+    period = rng.uniform(60, 1200)
+    values = rng.uniform(-100, 100) + rng.uniform(1, 50) * np.sin(t / period)
+    values += rng.normal(0, 0.1, sample_numbers)
+
+    return np.char.mod("%.3f", values)
+
+
+def gen_flight_csv(
+    need_vars,
+    seconds=3600,
+    columns=3000,
+    date_format=DATE_FORMATS[0],
+    blank_share=0.01,
+    truncate_tail=True,
+    seed=0,
+):
+    """
+    返回csv文本：第一行为重复的表头(每个参数按采样率重复)，随后两行为单位和说明，
+    之后每秒一行；DATE在第一列，其余参数顺序随机，部分单元格为空，末行可能被截断
+    """
+    rng = np.random.default_rng(seed)
+    rates = gen_rates(need_vars, columns, rng=rng)
+    names = [var for var in rates if var != "DATE"]
+    rng.shuffle(names)
+    names.insert(0, "DATE")
+
+    start = datetime.datetime(2024, 1, 1) + datetime.timedelta(
+        seconds=int(rng.integers(0, 365 * 86400))
+    )
+    date_list = [
+        (start + datetime.timedelta(seconds=second)).strftime(date_format)
+        for second in range(seconds)
+    ]
+
+    blocks = [np.asarray(date_list).reshape(seconds, 1)]
+    for var in names[1:]:
+        rate = rates[var]
+        values = gen_column_values(var, rate, seconds, rng)
+        values = values.astype(object).reshape(seconds, rate)
+        if blank_share and var not in COG_DIGITS:
+            # 第一行之外随机留空，处理时按缺失值插值补齐
+            blank = rng.random(values.shape) < blank_share
+            blank[0] = False
+            values[blank] = ""
+        blocks.append(values)
+    table = np.concatenate(blocks, axis=1)
+
+    header = [var for var in names for _ in range(rates[var])]
+    lines = [
+        ",".join(header),
+        ",".join("unit" for _ in header),
+        ",".join("description" for _ in header),
+    ]
+    lines.extend(",".join(row) for row in table)
+    if truncate_tail:
+        # 模拟记录中断：最后一行只保留一部分，DATE之后截断
+        last_line = lines[-1]
+        cut = int(rng.integers(len(date_list[-1]) + 1, len(last_line)))
+        lines[-1] = last_line[:cut]
+        return "\n".join(lines)
+
+    return "\n".join(lines) + "\n"
+
+
+def write_flight_zip(file_name, csv_text):
+    with zipfile.ZipFile(file_name, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(
+            f"{os.path.splitext(os.path.basename(file_name))[0]}.csv", csv_text
+        )
+
+
+def gen_flight_zips(
+    output_folder,
+    need_vars,
+    files=4,
+    seconds=3600,
+    columns=3000,
+    blank_share=0.01,
+    seed=0,
+):
+    """
+    生成files个zip文件，两种时间格式交替出现，文件时长在seconds的1/4到1倍之间变化
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    file_names = []
+    for index in range(files):
+        file_seconds = max(2, int(seconds * rng.uniform(0.25, 1)))
+        csv_text = gen_flight_csv(
+            need_vars,
+            seconds=file_seconds,
+            columns=columns,
+            date_format=DATE_FORMATS[index % len(DATE_FORMATS)],
+            blank_share=blank_share,
+            truncate_tail=index % 2 == 1,
+            seed=seed * 1000 + index,
+        )
+        file_name = os.path.join(output_folder, f"SYN{index:04d}.zip")
+        write_flight_zip(file_name, csv_text)
+        file_names.append(file_name)
+
+    return file_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-o", "--output-folder", default="./synthetic")
+    parser.add_argument("--files", type=int, default=4, help="生成的文件个数")
+    parser.add_argument("--seconds", type=int, default=3600, help="最长航段时长（行数）")
+    parser.add_argument("--columns", type=int, default=3000, help="表头列数")
+    parser.add_argument("--blank-share", type=float, default=0.01, help="空值比例")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--need-vars", default="./configs/need_vars.csv")
+    args = parser.parse_args()
+
+    need_vars = get_need_vars_from_csv(args.need_vars)
+    file_names = gen_flight_zips(
+        args.output_folder,
+        need_vars,
+        files=args.files,
+        seconds=args.seconds,
+        columns=args.columns,
+        blank_share=args.blank_share,
+        seed=args.seed,
+    )
+    print(f"已生成{len(file_names)}个文件: {args.output_folder}")
+
+
+if __name__ == "__main__":
+    main()
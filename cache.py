@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+import shutil
+
+from preprocess import PROCESS_VERSION, get_pure_name_list, get_zip_fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+def gen_cache_key(
+    zip_fingerprint, need_vars, output_format, process_version, var_dtypes=None
+):
+    """
+    缓存键由zip内容指纹、参数列表、输出格式、处理版本和参数数据类型配置共同决定，
+    任一项改变都需要重新处理
+    """
+    if zip_fingerprint is None:
+        return None
+
+    cache_key = hashlib.sha256()
+    cache_key.update(zip_fingerprint.encode())
+    cache_key.update(",".join(need_vars).encode())
+    cache_key.update(output_format.upper().encode())
+    cache_key.update(str(process_version).encode())
+    if var_dtypes:
+        # 不使用数据类型配置时缓存键与之前的版本保持一致
+        var_dtype_list = [f"{var}:{dtype}" for var, dtype in sorted(var_dtypes.items())]
+        cache_key.update(",".join(var_dtype_list).encode())
+
+    return cache_key.hexdigest()
+
+
+def link_or_copy(source_file, target_file):
+    # 同一磁盘上用硬链接，不占用额外空间
+    if os.path.exists(target_file):
+        os.remove(target_file)
+    try:
+        os.link(source_file, target_file)
+    except OSError:
+        shutil.copyfile(source_file, target_file)
+
+
+class ProcessingCache:
+    """
+    以缓存键为文件名保存处理结果，命中时直接取出，无需重新处理；
+    总大小超过max_size时按最近使用时间删除最旧的条目
+    """
+
+    def __init__(self, cache_folder, max_size):
+        os.makedirs(cache_folder, exist_ok=True)
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+
+    def get_cache_file(self, cache_key, output_suffix):
+        return os.path.join(self.cache_folder, f"{cache_key}{output_suffix}")
+
+    def load(self, cache_key, output_file):
+        """
+        命中时把缓存的结果放到output_file并返回True
+        """
+        if cache_key is None:
+            return False
+        cache_file = self.get_cache_file(cache_key, os.path.splitext(output_file)[1])
+        if not os.path.exists(cache_file):
+            return False
+
+        # 更新修改时间，作为最近使用时间
+        os.utime(cache_file)
+        link_or_copy(cache_file, output_file)
+
+        return True
+
+    def store(self, cache_key, output_file):
+        if cache_key is None:
+            return
+        cache_file = self.get_cache_file(cache_key, os.path.splitext(output_file)[1])
+        # 先写临时文件再改名，避免留下不完整的缓存
+        temp_file = f"{cache_file}.tmp"
+        link_or_copy(output_file, temp_file)
+        os.replace(temp_file, cache_file)
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_folder):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, file_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(file_path)
+            total_size -= size
+            removed += 1
+
+        if removed:
+            logger.info("缓存超过上限，删除了%s个最久未使用的条目", removed)
+
+        return removed
+
+
+def select_todo_zip_sources(
+    zip_source_s, done_cache_key_dict, need_vars, output_format, var_dtypes=None
+):
+    """
+    返回需要处理的zip文件列表及每个文件的缓存键：处理过且缓存键不变的文件跳过，
+    zip内容、参数列表、输出格式或处理版本改变的文件重新处理；
+    旧版本导入的文件没有缓存键，无法确认结果是否有效，同样重新处理一次
+    """
+    todo_zip_source_s = []
+    cache_key_dict = {}
+    for zip_source in zip_source_s:
+        zip_name = get_pure_name_list([zip_source]).pop()
+        cache_key = gen_cache_key(
+            get_zip_fingerprint(zip_source),
+            need_vars,
+            output_format,
+            PROCESS_VERSION,
+            var_dtypes,
+        )
+        if zip_name in done_cache_key_dict:
+            if done_cache_key_dict[zip_name] == cache_key:
+                continue
+            if done_cache_key_dict[zip_name] is None:
+                logger.info("%s没有缓存键，重新处理", zip_name)
+            else:
+                logger.info("%s的内容或处理参数已经改变，重新处理", zip_name)
+        todo_zip_source_s.append(zip_source)
+        cache_key_dict[zip_name] = cache_key
+
+    return todo_zip_source_s, cache_key_dict
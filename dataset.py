@@ -0,0 +1,233 @@
+import queue
+import threading
+
+import numpy as np
+
+from utility import (
+    list_output_files,
+    load_dataframe,
+    open_output_file,
+    trans_output_dates,
+)
+
+# 处理后的输出统一插值到16Hz
+OUTPUT_SAMPLE_RATE = 16
+
+# 后台线程等待队列时的检查间隔，用于及时响应使用方提前结束迭代
+PREFETCH_POLL = 0.1
+
+
+def prefetch_iter(iterable, prefetch=0):
+    """
+    用后台线程提前读取prefetch项，读取与使用方的计算重叠；prefetch为0时不启动线程
+    """
+    if not prefetch:
+        return iter(iterable)
+
+    return _prefetch_iter(iterable, prefetch)
+
+
+def _prefetch_iter(iterable, prefetch):
+    item_queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # 使用方提前结束时不再阻塞，后台线程随之退出
+        while not stop.is_set():
+            try:
+                item_queue.put(item, timeout=PREFETCH_POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = item_queue.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class FlightDataset:
+    """
+    对处理后输出文件的惰性访问：创建时只列出航班(只读取文件夹和Release分卷的目录)，
+    访问某个航班时才读取需要的参数和时间窗口内的行，返回{参数名: NumPy数组}；
+    所有输出格式的DATE都转换为datetime64[ns]，TSV中没有日期，从1970-01-01开始；
+    select返回新的数据集，不读取任何数据
+    """
+
+    def __init__(
+        self,
+        input_path_s,
+        columns=None,
+        time_window=None,
+        sample_rate=OUTPUT_SAMPLE_RATE,
+        _output_file_s=None,
+    ):
+        if isinstance(input_path_s, str):
+            input_path_s = [input_path_s]
+        self.input_path_s = list(input_path_s)
+        # columns为None时读取全部参数，否则DATE总是包含在内
+        self.columns = (
+            None if columns is None else list(dict.fromkeys(["DATE", *columns]))
+        )
+        # 时间窗口为相对航班起点的(起始秒, 结束秒)，结束秒为None时到航班结束
+        self.time_window = time_window
+        self.sample_rate = sample_rate
+        if _output_file_s is None:
+            _output_file_s = list_output_files(self.input_path_s)
+        self._output_file_s = _output_file_s
+
+    def __len__(self):
+        return len(self._output_file_s)
+
+    def __repr__(self):
+        return (
+            f"FlightDataset({len(self)}个航班, columns={self.columns}, "
+            f"time_window={self.time_window})"
+        )
+
+    @property
+    def zip_names(self):
+        return [output_file[0] for output_file in self._output_file_s]
+
+    def select(self, columns=None, time_window=None, zip_names=None):
+        """
+        返回只包含指定参数、时间窗口和航班的新数据集，未指定的条件沿用当前设置
+        """
+        output_file_s = self._output_file_s
+        if zip_names is not None:
+            zip_name_set = set(zip_names)
+            output_file_s = [
+                output_file
+                for output_file in output_file_s
+                if output_file[0] in zip_name_set
+            ]
+
+        return FlightDataset(
+            self.input_path_s,
+            columns=self.columns if columns is None else columns,
+            time_window=self.time_window if time_window is None else time_window,
+            sample_rate=self.sample_rate,
+            _output_file_s=output_file_s,
+        )
+
+    def _get_row_range(self):
+        if self.time_window is None:
+            return 0, None
+        start_second, end_second = self.time_window
+        row_start = int(start_second * self.sample_rate)
+        if end_second is None:
+            return row_start, None
+
+        return row_start, max(int(end_second * self.sample_rate) - row_start, 0)
+
+    def load(self, index):
+        """
+        读取第index个航班(或zip文件名为index的航班)，返回(zip文件名, {参数名: 数组})
+        """
+        if isinstance(index, str):
+            index = self.zip_names.index(index)
+        zip_name, output_format, file_path, member_name = self._output_file_s[index]
+
+        row_start, row_count = self._get_row_range()
+        dataframe = load_dataframe(
+            open_output_file(file_path, member_name),
+            output_format,
+            columns=self.columns,
+            row_start=row_start,
+            row_count=row_count,
+        )
+        columns = self.columns or list(dataframe.columns)
+        flight_data = {column: dataframe[column].to_numpy() for column in columns}
+        # 不同格式的DATE类型一致，跨格式分批时可以直接拼接
+        if "DATE" in flight_data:
+            flight_data["DATE"] = trans_output_dates(flight_data["DATE"])
+
+        return zip_name, flight_data
+
+    def __getitem__(self, index):
+        return self.load(index)
+
+    def _iter_flights(self):
+        for index in range(len(self)):
+            yield self.load(index)
+
+    def iter_flights(self, prefetch=0):
+        """
+        逐个航班返回(zip文件名, {参数名: 数组})，prefetch>0时用后台线程提前读取
+        """
+        return prefetch_iter(self._iter_flights(), prefetch)
+
+    def __iter__(self):
+        return self.iter_flights()
+
+    def iter_batches(self, batch_size, prefetch=0, drop_last=False):
+        """
+        把所有航班的行首尾相接，按batch_size行分批返回{参数名: 数组}，
+        其中zip_name数组记录每一行所属的航班；最后不足batch_size的一批drop_last时丢弃
+        """
+        return prefetch_iter(self._iter_batches(batch_size, drop_last), prefetch)
+
+    def _iter_batches(self, batch_size, drop_last):
+        pending = []
+        pending_rows = 0
+        for zip_name, flight_data in self._iter_flights():
+            row_count = len(flight_data["DATE"])
+            if row_count == 0:
+                continue
+            flight_data = dict(
+                flight_data, zip_name=np.full(row_count, zip_name, dtype=object)
+            )
+            pending.append(flight_data)
+            pending_rows += row_count
+            while pending_rows >= batch_size:
+                batch, pending = self._split_rows(pending, batch_size)
+                pending_rows -= batch_size
+                yield batch
+
+        if pending_rows and not drop_last:
+            batch, _ = self._split_rows(pending, pending_rows)
+            yield batch
+
+    @staticmethod
+    def _split_rows(pending, row_count):
+        # 从pending的开头取出row_count行拼成一批，其余留在pending中
+        parts = []
+        rest = []
+        for flight_data in pending:
+            flight_rows = len(flight_data["DATE"])
+            if row_count == 0:
+                rest.append(flight_data)
+            elif flight_rows <= row_count:
+                parts.append(flight_data)
+                row_count -= flight_rows
+            else:
+                items = flight_data.items()
+                parts.append({key: value[:row_count] for key, value in items})
+                rest.append({key: value[row_count:] for key, value in items})
+                row_count = 0
+
+        # 不同航班的参数可能不同，只保留所有航班都有的参数
+        keys = [key for key in parts[0] if all(key in part for part in parts)]
+        batch = {key: np.concatenate([part[key] for part in parts]) for key in keys}
+
+        return batch, rest
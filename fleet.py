@@ -0,0 +1,377 @@
+import datetime
+import logging
+import os
+import sqlite3
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from utility import (
+    DATE_DTYPE,
+    list_output_files,
+    load_dataframe,
+    open_output_file,
+    trans_output_dates,
+)
+
+logger = logging.getLogger(__name__)
+
+
+FLEET_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    zip_name TEXT PRIMARY KEY,
+    uid8 TEXT,
+    ac_reg TEXT,
+    departure_icao TEXT,
+    arrival_icao TEXT,
+    flight_date TEXT,
+    row_start INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    added_at TEXT,
+    cache_key TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_flights_uid8 ON flights (uid8);
+CREATE INDEX IF NOT EXISTS idx_flights_ac_reg ON flights (ac_reg, flight_date);
+CREATE INDEX IF NOT EXISTS idx_flights_departure_icao ON flights (departure_icao);
+CREATE INDEX IF NOT EXISTS idx_flights_arrival_icao ON flights (arrival_icao);
+CREATE INDEX IF NOT EXISTS idx_flights_flight_date ON flights (flight_date);
+
+CREATE TABLE IF NOT EXISTS channels (
+    name TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    dtype TEXT NOT NULL
+);
+"""
+
+# 旧版本的fleet.db打开时补充缺少的列
+FLEET_MIGRATIONS = {
+    "flights": {"cache_key": "TEXT"},
+}
+
+# 航班列表中记录航班日期的字段，按顺序取第一个能解析为日期的值
+FLIGHT_DATE_KEYS = ("flightDate", "takeOffTime", "takeoffTime", "startTime")
+
+# 航班索引中可以用于筛选的字段
+FLIGHT_FILTERS = ("uid8", "ac_reg", "departure_icao", "arrival_icao")
+
+CHANNEL_DTYPE = "<f8"
+
+
+def gen_flight_meta(flight_info):
+    """
+    从航班列表的信息中取出建立索引的字段，没有对应航班时各字段为None
+    """
+    flight_info = flight_info or {}
+    flight_date = None
+    for key in FLIGHT_DATE_KEYS:
+        if flight_info.get(key):
+            try:
+                flight_date = pd.Timestamp(flight_info[key]).strftime("%Y-%m-%d")
+            except ValueError:
+                continue
+            break
+
+    return {
+        "uid8": flight_info.get("uid8"),
+        "ac_reg": flight_info.get("acReg"),
+        "departure_icao": flight_info.get("departureIcao"),
+        "arrival_icao": flight_info.get("arrivalIcao"),
+        "flight_date": flight_date,
+    }
+
+
+class FleetStore:
+    """
+    全机队的参数存储：每个参数一个可以内存映射的二进制文件，所有航班按行首尾相接，
+    各参数文件按行对齐；航班索引(uid8、机号、起降机场、日期及所在的行范围)保存在SQLite中，
+    查询时只映射需要的参数、只读取选中航班的行
+    """
+
+    def __init__(self, store_folder):
+        os.makedirs(os.path.join(store_folder, "columns"), exist_ok=True)
+        self.store_folder = store_folder
+        self._conn = sqlite3.connect(os.path.join(store_folder, "fleet.db"))
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.executescript(FLEET_SCHEMA)
+            for table, columns in FLEET_MIGRATIONS.items():
+                exist_columns = {
+                    row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")
+                }
+                for column, column_type in columns.items():
+                    if column not in exist_columns:
+                        self._conn.execute(
+                            f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+                        )
+        self._recover_columns()
+
+    def close(self):
+        self._conn.close()
+
+    def _execute(self, sql, parameters=()):
+        with self._conn:
+            return self._conn.execute(sql, parameters).fetchall()
+
+    @property
+    def total_rows(self):
+        (total_rows,) = self._execute(
+            "SELECT COALESCE(MAX(row_start + row_count), 0) FROM flights"
+        )[0]
+        return total_rows
+
+    def get_channels(self):
+        # {参数名: (文件路径, 数据类型)}，DATE在最前
+        rows = self._execute(
+            """
+            SELECT name, file_name, dtype FROM channels
+            ORDER BY name != 'DATE', rowid
+            """
+        )
+        return {
+            row["name"]: (
+                os.path.join(self.store_folder, "columns", row["file_name"]),
+                np.dtype(row["dtype"]),
+            )
+            for row in rows
+        }
+
+    def _recover_columns(self):
+        # 写入中断时参数文件可能比索引中记录的行数长或短，按索引截断或补齐
+        total_rows = self.total_rows
+        for name, (file_path, dtype) in self.get_channels().items():
+            expect_size = total_rows * dtype.itemsize
+            file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            if file_size > expect_size:
+                with open(file_path, "r+b") as f:
+                    f.truncate(expect_size)
+            elif file_size < expect_size:
+                logger.warning("%s的数据不完整，缺失部分用空值补齐", name)
+                with open(file_path, "ab") as f:
+                    f.truncate(file_size // dtype.itemsize * dtype.itemsize)
+                    self._fill_rows(f, dtype, total_rows - file_size // dtype.itemsize)
+
+    @staticmethod
+    def _fill_rows(f, dtype, row_count):
+        fill_value = np.datetime64("NaT") if dtype.kind == "M" else np.nan
+        np.full(row_count, fill_value, dtype=dtype).tofile(f)
+
+    def get_done_cache_key_dict(self):
+        # 已经加入的航班及其输出的缓存键，旧版本加入的航班缓存键为None
+        rows = self._execute("SELECT zip_name, cache_key FROM flights")
+        return {row["zip_name"]: row["cache_key"] for row in rows}
+
+    def add_flight(self, zip_name, dataframe, flight_meta=None, cache_key=None):
+        """
+        把一个航班的输出追加到所有参数文件的末尾；其他航班没有的参数在这些航班的行填空值；
+        航班已经存在时索引改为指向新追加的行，原来的行不再被引用
+        """
+        flight_meta = dict(flight_meta or gen_flight_meta(None))
+        date_values = np.asarray(dataframe["DATE"])
+        if flight_meta["flight_date"] is None and len(date_values):
+            # 二进制格式的DATE带有日期，TSV中没有日期时不做猜测
+            if np.issubdtype(date_values.dtype, np.datetime64):
+                flight_meta["flight_date"] = str(date_values[0].astype("M8[D]"))
+
+        # 先全部转换完成再写入，转换失败时不留下写了一半的数据
+        arrays = {"DATE": trans_output_dates(date_values, flight_meta["flight_date"])}
+        for name in dataframe.columns:
+            if name != "DATE":
+                arrays[name] = np.asarray(dataframe[name], dtype=CHANNEL_DTYPE)
+        row_start = self.total_rows
+        row_count = len(dataframe)
+
+        channels = self.get_channels()
+        for name in arrays:
+            if name in channels:
+                continue
+            dtype = np.dtype(DATE_DTYPE if name == "DATE" else CHANNEL_DTYPE)
+            file_name = f"{len(channels):05d}.bin"
+            file_path = os.path.join(self.store_folder, "columns", file_name)
+            # 新参数在已有航班的行填空值，保证所有参数文件按行对齐
+            with open(file_path, "wb") as f:
+                self._fill_rows(f, dtype, row_start)
+            self._execute(
+                "INSERT INTO channels (name, file_name, dtype) VALUES (?, ?, ?)",
+                (name, file_name, dtype.str),
+            )
+            channels[name] = (file_path, dtype)
+
+        for name, (file_path, dtype) in channels.items():
+            with open(file_path, "ab") as f:
+                if name in arrays:
+                    arrays[name].tofile(f)
+                else:
+                    self._fill_rows(f, dtype, row_count)
+
+        # 数据写完后再记录索引，中断时多写的行在下次打开时截断；
+        # 替换已有航班时新行在末尾，总行数不会因为删除旧记录而变小
+        self._execute(
+            """
+            INSERT OR REPLACE INTO flights (
+                zip_name, uid8, ac_reg, departure_icao, arrival_icao,
+                flight_date, row_start, row_count, added_at, cache_key
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                zip_name,
+                flight_meta["uid8"],
+                flight_meta["ac_reg"],
+                flight_meta["departure_icao"],
+                flight_meta["arrival_icao"],
+                flight_meta["flight_date"],
+                row_start,
+                row_count,
+                datetime.datetime.now().isoformat(timespec="seconds"),
+                cache_key,
+            ),
+        )
+
+    def find_flights(self, date_from=None, date_to=None, **filters):
+        """
+        按uid8、ac_reg、departure_icao、arrival_icao(单个值或列表)和日期范围(含两端)
+        在索引中查找航班，返回按日期排序的航班信息列表
+        """
+        conditions = []
+        parameters = []
+        for key, value in filters.items():
+            if key not in FLIGHT_FILTERS:
+                raise ValueError(f"不支持按{key}查询，可用的字段为{FLIGHT_FILTERS}")
+            if value is None:
+                continue
+            values = [value] if isinstance(value, str) else list(value)
+            if not values:
+                continue
+            conditions.append(f"{key} IN ({', '.join('?' * len(values))})")
+            parameters.extend(values)
+        if date_from is not None:
+            conditions.append("flight_date >= ?")
+            parameters.append(str(date_from))
+        if date_to is not None:
+            conditions.append("flight_date <= ?")
+            parameters.append(str(date_to))
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._execute(
+            f"SELECT * FROM flights {where} ORDER BY flight_date, row_start", parameters
+        )
+        return [dict(row) for row in rows]
+
+    def open_columns(self, channels):
+        """
+        返回{参数名: 只读的内存映射数组}，DATE总是包含在内
+        """
+        all_channels = self.get_channels()
+        channels = list(dict.fromkeys(["DATE", *channels]))
+        missing_channels = [name for name in channels if name not in all_channels]
+        if missing_channels:
+            raise ValueError(f"机队存储中缺少参数{missing_channels}")
+
+        total_rows = self.total_rows
+        columns = {}
+        for name in channels:
+            file_path, dtype = all_channels[name]
+            if total_rows == 0:
+                columns[name] = np.empty(0, dtype=dtype)
+            else:
+                columns[name] = np.memmap(
+                    file_path, dtype=dtype, mode="r", shape=(total_rows,)
+                )
+
+        return columns
+
+    def query(self, channels, date_from=None, date_to=None, **filters):
+        """
+        逐个返回(航班信息, {参数名: 数组})，数组是内存映射的切片，访问时才从磁盘读取
+        """
+        flights = self.find_flights(date_from=date_from, date_to=date_to, **filters)
+        columns = self.open_columns(channels)
+        for flight in flights:
+            row_start = flight["row_start"]
+            row_slice = slice(row_start, row_start + flight["row_count"])
+            yield flight, {name: column[row_slice] for name, column in columns.items()}
+
+    def query_dataframe(self, channels, date_from=None, date_to=None, **filters):
+        # 把查询结果合并为一个DataFrame，前几列为航班索引字段
+        frames = []
+        for flight, flight_columns in self.query(
+            channels, date_from=date_from, date_to=date_to, **filters
+        ):
+            frame = pd.DataFrame(
+                {name: np.asarray(value) for name, value in flight_columns.items()}
+            )
+            for key in reversed(("zip_name", *FLIGHT_FILTERS, "flight_date")):
+                frame.insert(0, key, flight[key])
+            frames.append(frame)
+
+        if not frames:
+            return pd.DataFrame(
+                columns=["zip_name", *FLIGHT_FILTERS, "flight_date", "DATE", *channels]
+            )
+        return pd.concat(frames, ignore_index=True)
+
+
+def select_latest_output_files(output_file_s):
+    """
+    同一个zip文件在输出文件夹和多个Release分卷中都有输出时，只保留修改时间最新的一个
+    """
+    volume_time_dict = {}
+
+    def get_output_time(file_path, member_name):
+        if member_name is None:
+            return os.path.getmtime(file_path)
+        if file_path not in volume_time_dict:
+            with zipfile.ZipFile(file_path) as volume:
+                volume_time_dict[file_path] = {
+                    info.filename: datetime.datetime(*info.date_time).timestamp()
+                    for info in volume.infolist()
+                }
+        return volume_time_dict[file_path][member_name]
+
+    latest_dict = {}
+    for output_file in output_file_s:
+        output_time = get_output_time(output_file[2], output_file[3])
+        zip_name = output_file[0]
+        if zip_name not in latest_dict or output_time > latest_dict[zip_name][0]:
+            latest_dict[zip_name] = (output_time, output_file)
+
+    return [output_file for _, output_file in latest_dict.values()]
+
+
+def build_fleet_store(
+    store, input_path_s, file_flight_dict, file_cache_key_dict=None, pb=None
+):
+    """
+    把尚未加入的输出文件逐个加入机队存储，返回加入的航班数量；
+    file_cache_key_dict中记录的缓存键与加入时不同的航班(重新处理过)用最新的输出替换
+    """
+    file_cache_key_dict = file_cache_key_dict or {}
+    done_cache_key_dict = store.get_done_cache_key_dict()
+    added = 0
+    output_file_s = select_latest_output_files(list_output_files(input_path_s))
+    for zip_name, output_format, file_path, member_name in output_file_s:
+        cache_key = file_cache_key_dict.get(zip_name)
+        if zip_name in done_cache_key_dict:
+            if cache_key is None or done_cache_key_dict[zip_name] == cache_key:
+                continue
+            logger.info("%s重新处理过，替换机队存储中的数据", zip_name)
+        try:
+            dataframe = load_dataframe(
+                open_output_file(file_path, member_name), output_format
+            )
+            store.add_flight(
+                zip_name,
+                dataframe,
+                gen_flight_meta(file_flight_dict.get(zip_name)),
+                cache_key=cache_key,
+            )
+        except (ValueError, KeyError, OSError) as e:
+            logger.warning("%s无法加入机队存储，具体报错为%s", zip_name, e)
+            continue
+        done_cache_key_dict[zip_name] = cache_key
+        added += 1
+        if pb is not None:
+            pb.update(1)
+
+    return added
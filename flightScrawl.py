@@ -1,11 +1,17 @@
 import json
 import requests
-import gzip
 import base64
+import itertools
+import math
+import os
+import re
+import zlib
 import tqdm
 import time
 import logging
-from utility import save_json_date
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utility import get_output_suffix, save_json_date
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
@@ -16,11 +22,20 @@ from selenium.webdriver.support.wait import TimeoutException, WebDriverWait
 logger = logging.getLogger(__name__)
 
 
+class IncompleteDownloadError(IOError):
+    pass
+
+
 class FlightSpider:
-    def __init__(self) -> None:
+    def __init__(self, pool_size=10) -> None:
         self._session = requests.session()
+        # 并发下载时所有线程共用同一个连接池
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        self._session.mount("https://", adapter)
 
-    def get_uids(self, page_number, token, cookie):
+    def get_uids(self, page_number, token, cookie, page_size=100):
         url = "https://cis.comac.cc:8053/api/warehouse/v2/getFlightDataByHighQuery?sf_request_type=ajax"
 
         header = {
@@ -30,7 +45,7 @@ class FlightSpider:
             "Cookie": cookie,
             "version": "v2",
         }
-        post_data = {"pageNo": page_number, "pageSize": "100", "sourceId": ""}
+        post_data = {"pageNo": page_number, "pageSize": str(page_size), "sourceId": ""}
         res = self._session.post(url, data=json.dumps(post_data), headers=header)
         if res.status_code == 200:
             return res.text
@@ -38,7 +53,106 @@ class FlightSpider:
             logger.warning("statusCode = %s", res.status_code)
             return False
 
-    def download_load_by_uid8(self, uid_8, token, cookie, path, need_vars):
+    def get_page_list(self, page_number, token, cookie, page_size=100):
+        res_json = self.get_uids(str(page_number), token, cookie, page_size)
+        if res_json is False:
+            raise requests.HTTPError(f"第{page_number}页航班列表获取失败")
+
+        return json.loads(res_json)["result"]
+
+    def get_flight_list(self, token, cookie, page_number_hint, page_size=100, jobs=4):
+        """
+        并发获取全部航班列表，结果按页码顺序合并
+        """
+        first_page = self.get_page_list(1, token, cookie, page_size)
+        # 优先使用接口返回的总数计算页数，否则按网页上的页数(每页100条)换算
+        if "total" in first_page:
+            page_number = math.ceil(int(first_page["total"]) / page_size)
+        else:
+            page_number = math.ceil(page_number_hint * 100 / page_size)
+
+        page_list = [first_page["list"]]
+        tqdm_params = {
+            "total": page_number,
+            "initial": 1,
+        }
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pages = executor.map(
+                lambda i: self.get_page_list(i, token, cookie, page_size)["list"],
+                range(2, page_number + 1),
+            )
+            with tqdm.tqdm(**tqdm_params) as pb:
+                for page in pages:
+                    # 每下载一页数据，进度条＋1
+                    pb.update(1)
+                    page_list.append(page)
+
+        return list(itertools.chain.from_iterable(page_list))
+
+    def get_new_flight_list(self, token, cookie, old_json_list, page_size=100):
+        """
+        假设航班列表按从新到旧排序，逐页获取直到遇到上次已知的航班为止；
+        若发现排序假设不成立，返回None，由调用方退回全量获取
+        """
+        if not old_json_list:
+            return None
+
+        old_uid8_set = {flight_info["uid8"] for flight_info in old_json_list}
+        # 上次获取时最新的航班，应当是本次遇到的第一个已知航班
+        newest_uid8 = old_json_list[0]["uid8"]
+
+        new_json_list = []
+        page_number = 1
+        with tqdm.tqdm(desc="增量获取航班列表") as pb:
+            while True:
+                page = self.get_page_list(page_number, token, cookie, page_size)["list"]
+                if not page:
+                    break
+
+                pb.update(1)
+                seen_known = False
+                for flight_info in page:
+                    if flight_info["uid8"] in old_uid8_set:
+                        if not seen_known and flight_info["uid8"] != newest_uid8:
+                            logger.warning(
+                                "第一个已知航班为%s而不是%s，航班列表顺序与预期不符",
+                                flight_info["uid8"],
+                                newest_uid8,
+                            )
+                            return None
+                        seen_known = True
+                    elif seen_known:
+                        logger.warning(
+                            "已知航班之后出现了新航班%s，航班列表不是按从新到旧排序",
+                            flight_info["uid8"],
+                        )
+                        return None
+
+                new_json_list.extend(page)
+                # 已经衔接上次的航班列表，之后的页面都是已知航班
+                if seen_known:
+                    break
+                page_number += 1
+
+        # 新获取的航班在前，其余沿用上次的航班列表
+        new_uid8_set = {flight_info["uid8"] for flight_info in new_json_list}
+        return new_json_list + [
+            flight_info
+            for flight_info in old_json_list
+            if flight_info["uid8"] not in new_uid8_set
+        ]
+
+    def download_load_by_uid8(
+        self,
+        uid_8,
+        token,
+        cookie,
+        path,
+        need_vars,
+        output_format="TSV",
+        keep_raw=False,
+        var_dtypes=None,
+    ):
         url = f"https://cis.comac.cc:8053/api/vis/api/v2/getHiveData?id={uid_8}&dataType=EAFR&params=UTCData,{need_vars}&timeStamp=true&jsonStream=true&sf_request_type=ajax"
 
         header = {
@@ -49,56 +163,208 @@ class FlightSpider:
             "Cookie": cookie,
         }
 
-        with self._session.get(url=url, headers=header) as respond:
+        with self._session.get(url=url, headers=header, stream=True) as respond:
             respond.raise_for_status()
-            debase = base64.b64decode(respond.content)
-            json_str = gzip.decompress(debase).decode()
-            try:
-                json_data = json.loads(json_str)
-                with open(f"{path}.json", "w") as f:
-                    json.dump(json_data, f, indent=2)
-                    del json_data["UTCData"]
-                    del json_data["UTCMark"]
-                    del json_data["FLIGHT_PHASE"]
-                    save_json_date(json_data, f"{path}.txt")
-            except json.decoder.JSONDecodeError:
-                logger.warning(
-                    "Response is empty or data is not valid JSON, data uid8 is %s.",
-                    uid_8,
-                )
+            chunks = respond.iter_content(chunk_size=65536)
+            # 需要保留原始数据时，直接存储服务器返回的gzip数据，不重新编码
+            if keep_raw:
+                with open(f"{path}.json.gz", "wb") as raw_file:
+                    json_bytes = b"".join(decode_base64_gzip(chunks, raw_file))
+            else:
+                json_bytes = b"".join(decode_base64_gzip(chunks))
 
-    def download_by_uid8(self, uid_8, token, cookie, path):
+        try:
+            json_data = json.loads(json_bytes)
+            del json_bytes
+            del json_data["UTCData"]
+            del json_data["UTCMark"]
+            del json_data["FLIGHT_PHASE"]
+            output_suffix = get_output_suffix(output_format)
+            save_json_date(
+                json_data, f"{path}{output_suffix}", output_format, var_dtypes
+            )
+        except json.decoder.JSONDecodeError:
+            logger.warning(
+                "Response is empty or data is not valid JSON, data uid8 is %s.",
+                uid_8,
+            )
+            return None
+
+        return f"{path}{output_suffix}"
+
+    def download_by_uid8(
+        self, uid_8, token, cookie, path, show_progress=True, max_retries=3
+    ):
         url = "https://cis.comac.cc:8053/api/qar1/flightTaskDownloadFile?sf_request_type=ajax"
 
         header = {
             "Accept": "application/json, text/plain, */*",
             "Content-Type": "application/json; charset=utf-8",
-            "Accept-Encoding": "gzip, deflate, br, zstd",
+            # 断点续传和完整性校验都以原始字节计算，不使用传输压缩
+            "Accept-Encoding": "identity",
             "X-Access-Token": token,
             "Cookie": cookie,
             "version": "v2",
         }
         postData = {"freq": "64", "uid8Arr": [uid_8], "dataType": ["EAFR"]}
-        with open(path, "wb") as f:
-            with self._session.post(
-                url, data=json.dumps(postData), headers=header, stream=True
-            ) as r:
-                r.raise_for_status()
-                total = int(r.headers.get("content-length", 0))
-
-                # tqdm has many interesting parameters. Feel free to experiment!
-                tqdm_params = {
-                    "desc": uid_8,
-                    "total": total,
-                    "miniters": 1,
-                    "unit": "B",
-                    "unit_scale": True,
-                    "unit_divisor": 1024,
-                }
-                with tqdm.tqdm(**tqdm_params) as pb:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        pb.update(len(chunk))
-                        f.write(chunk)
+
+        # 先写入.part文件，下载完整后再原子地重命名为目标文件
+        part_path = f"{path}.part"
+        for retry in range(max_retries + 1):
+            try:
+                self._download_part(
+                    url, postData, header, part_path, uid_8, show_progress
+                )
+                break
+            except (
+                requests.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                IncompleteDownloadError,
+            ) as e:
+                if retry == max_retries:
+                    raise
+                logger.warning("%s下载中断，尝试断点续传，具体报错为%s", uid_8, e)
+
+        os.replace(part_path, path)
+
+    def _download_part(self, url, post_data, header, part_path, uid_8, show_progress):
+        resume_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if resume_size:
+            header = {**header, "Range": f"bytes={resume_size}-"}
+
+        with self._session.post(
+            url, data=json.dumps(post_data), headers=header, stream=True
+        ) as r:
+            if r.status_code == 416:
+                # 服务器不接受当前的断点位置，删除.part文件后从头下载
+                os.remove(part_path)
+                raise IncompleteDownloadError(f"{uid_8}断点位置{resume_size}无效")
+            r.raise_for_status()
+
+            content_range = r.headers.get("content-range", "")
+            if r.status_code == 206 and content_range.startswith(
+                f"bytes {resume_size}-"
+            ):
+                mode = "ab"
+            elif r.status_code == 206:
+                os.remove(part_path)
+                raise IncompleteDownloadError(
+                    f"{uid_8}返回的数据范围{content_range}与断点位置{resume_size}不一致"
+                )
+            else:
+                # 服务器不支持Range请求，从头下载
+                resume_size = 0
+                mode = "wb"
+
+            content_length = r.headers.get("content-length")
+            total = resume_size + int(content_length) if content_length else None
+
+            # tqdm has many interesting parameters. Feel free to experiment!
+            tqdm_params = {
+                "desc": uid_8,
+                "total": total,
+                "initial": resume_size,
+                "miniters": 1,
+                "unit": "B",
+                "unit_scale": True,
+                "unit_divisor": 1024,
+                "disable": not show_progress,
+            }
+            with open(part_path, mode) as f, tqdm.tqdm(**tqdm_params) as pb:
+                for chunk in r.iter_content(chunk_size=8192):
+                    pb.update(len(chunk))
+                    f.write(chunk)
+
+        # 根据Content-Length校验是否下载完整
+        received_size = os.path.getsize(part_path)
+        if total is not None and received_size != total:
+            raise IncompleteDownloadError(
+                f"{uid_8}下载不完整，已接收{received_size}字节，应为{total}字节"
+            )
+
+
+class Credential:
+    """
+    多线程共享的登录信息，cookies过期时只由一个线程负责重新登录
+    """
+
+    def __init__(self, user_name, user_password):
+        self._user_name = user_name
+        self._user_password = user_password
+        self._lock = threading.Lock()
+        self.chrome, self.token, self.cookie = chrome_runner(
+            user_name, user_password
+        )
+
+    def refresh(self, stale_token):
+        with self._lock:
+            # 其他线程已经刷新过，直接使用新的token
+            if self.token == stale_token:
+                self.chrome, self.token, self.cookie = chrome_runner(
+                    self._user_name, self._user_password
+                )
+
+        return self.token, self.cookie
+
+
+def download_concurrently(download_func, task_list, jobs, desc="航班下载进度"):
+    """
+    最多jobs个线程并发下载，task_list为(航班名称, download_func参数)的列表
+    """
+    tqdm_params = {
+        "desc": desc,
+        "total": len(task_list),
+        "miniters": 1,
+    }
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        future_dict = {
+            executor.submit(download_func, **kwargs): front_name
+            for front_name, kwargs in task_list
+        }
+        with tqdm.tqdm(**tqdm_params) as pb:
+            for future in as_completed(future_dict):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("%s下载失败，具体报错为%s", future_dict[future], e)
+                pb.update(1)
+
+
+# base64字母表之外的字节(换行、引号等)，与base64.b64decode一样在解码前去掉
+NON_BASE64_PATTERN = re.compile(rb"[^A-Za-z0-9+/=]")
+
+
+def decode_base64_gzip(chunks, raw_file=None):
+    # 边接收边解码base64+gzip响应，base64文本和gzip数据不需要整个保存在内存中，
+    # 解压后的JSON仍需由调用方拼接后再解析
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+
+    def decompress(gzip_data):
+        nonlocal decompressor
+        data_list = [decompressor.decompress(gzip_data)]
+        # 多个gzip成员首尾相接时，上一个成员之后的数据交给新的解压器
+        while decompressor.eof and decompressor.unused_data:
+            gzip_data = decompressor.unused_data
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            data_list.append(decompressor.decompress(gzip_data))
+        return b"".join(data_list)
+
+    remain = b""
+    for chunk in chunks:
+        # base64需要按4字节对齐解码，剩余部分留到下一块
+        chunk = remain + NON_BASE64_PATTERN.sub(b"", chunk)
+        aligned = len(chunk) - len(chunk) % 4
+        remain = chunk[aligned:]
+        gzip_data = base64.b64decode(chunk[:aligned])
+        if raw_file is not None:
+            raw_file.write(gzip_data)
+        yield decompress(gzip_data)
+
+    gzip_data = base64.b64decode(remain)
+    if raw_file is not None:
+        raw_file.write(gzip_data)
+    yield decompress(gzip_data)
+    yield decompressor.flush()
 
 
 def get_log_options():
@@ -1,21 +1,41 @@
 import shutil
 import time
-import json
+import queue
+import threading
 import glob
 import os
 import requests
-import sys
 import tqdm
 import datetime
-import subprocess
 import logging
 import click
-from flightScrawl import chrome_runner, FlightSpider, get_ul_list_number
-from preprocess import process_zip_to_txt, get_pure_name_list, get_need_vars_from_csv
+from flightScrawl import (
+    Credential,
+    FlightSpider,
+    download_concurrently,
+    get_ul_list_number,
+)
+from preprocess import (
+    expand_zip_sources,
+    get_need_vars_from_csv,
+    get_pure_name_list,
+    get_var_dtypes_from_csv,
+    init_process_worker,
+    iter_results_within_budget,
+    list_inner_zips,
+    process_zip_in_worker,
+    sort_zip_sources_by_size,
+)
 from pathos.multiprocessing import ProcessingPool as newpool
 from pathos import multiprocessing
-from utility import extract_zip
-from itertools import repeat
+from utility import extract_zip, get_output_suffix, save_dataframe
+from cache import ProcessingCache, select_todo_zip_sources
+from fleet import FleetStore, build_fleet_store
+from manifest import FlightManifest
+from profiling import format_stage_report
+from release import ReleasePacker
+from collections import deque
+from itertools import chain
 
 
 logger = logging.getLogger(__name__)
@@ -28,36 +48,217 @@ def folder_creator(folder_name: str):
 
 
 def json_compare(
-    chrome, flight_spider: FlightSpider, old_json_file: str, token, cookie
+    chrome,
+    flight_spider: FlightSpider,
+    manifest: FlightManifest,
+    token,
+    cookie,
+    page_size=100,
+    jobs=4,
+    list_mode="incremental",
 ):
-    # 获取最新、完整的json_list
-    li_number = get_ul_list_number(chrome)
-    # tqdm has many interesting parameters. Feel free to experiment!
-    # 设置下载进度条，抓取所有航班列表
-    print("获取全部航班列表")
-    whole_json_list = []
-    tqdm_params = {
-        "total": li_number,
-    }
-    with tqdm.tqdm(**tqdm_params) as pb:
-        for i in range(1, li_number + 1):
-            # 每下载一页数据，进度条＋1
-            pb.update(1)
-            res_json = flight_spider.get_uids(str(i), token, cookie)
-            whole_json_list = whole_json_list + json.loads(res_json)["result"]["list"]
-
-    # 读取旧json_list
-    with open(old_json_file, "r") as f:
-        old_json_list = json.load(f)
-
-    # 获取增量信息
-    old_uid8_set = set([flight_info["uid8"] for flight_info in old_json_list])
-    whole_uid8_set = set([flight_info["uid8"] for flight_info in whole_json_list])
-    added_uid8_set = whole_uid8_set - old_uid8_set
+    # 读取上次的航班列表
+    old_json_list = manifest.get_flight_list()
+
+    whole_json_list = None
+    if list_mode.lower() == "incremental":
+        # 只获取上次之后新增的航班，顺序假设不成立时退回全量获取
+        print("增量获取航班列表")
+        whole_json_list = flight_spider.get_new_flight_list(
+            token, cookie, old_json_list, page_size=page_size
+        )
+
+    if whole_json_list is None:
+        # 获取最新、完整的json_list
+        li_number = get_ul_list_number(chrome)
+        # 并发抓取所有航班列表
+        print("获取全部航班列表")
+        whole_json_list = flight_spider.get_flight_list(
+            token, cookie, li_number, page_size=page_size, jobs=jobs
+        )
+
+    # 逐个记录航班列表，获取尚未下载成功的航班
+    manifest.update_listed(whole_json_list)
+    added_uid8_set = manifest.get_pending_uid8_set()
 
     return chrome, added_uid8_set, whole_json_list
 
 
+def download_csv_flight(
+    flight_spider: FlightSpider,
+    credential: Credential,
+    manifest: FlightManifest,
+    uid_8,
+    file_name,
+    front_name,
+    output_folder,
+    keep_archive=False,
+):
+    token, cookie = credential.token, credential.cookie
+    try:
+        try:
+            flight_spider.download_by_uid8(
+                uid_8, token=token, cookie=cookie, path=file_name, show_progress=False
+            )
+        except requests.HTTPError as e:
+            logger.warning("出现%s, 可能cookies过期，尝试重新获取cookies", e)
+            token, cookie = credential.refresh(token)
+            flight_spider.download_by_uid8(
+                uid_8, token=token, cookie=cookie, path=file_name, show_progress=False
+            )
+    except Exception as e:
+        manifest.mark_download_error(uid_8, repr(e))
+        raise
+
+    # 提取zip文件，并记录其中每个zip文件对应的uid8
+    download_size = os.path.getsize(file_name)
+    try:
+        if keep_archive:
+            # 保留下载的压缩包，处理时直接从中读取，不再解压到磁盘
+            zip_source_s = [(file_name, name) for name in list_inner_zips(file_name)]
+        else:
+            name_list = extract_zip(file_name, output_folder)
+            zip_source_s = [
+                os.path.join(output_folder, name)
+                for name in name_list
+                if name.lower().endswith(".zip")
+            ]
+        manifest.mark_downloaded(
+            uid_8, download_size, get_pure_name_list(zip_source_s)
+        )
+    except:  # noqa: E722
+        logger.error("%s.zip无法解压，跳过", front_name)
+        manifest.mark_download_error(uid_8, f"{front_name}.zip无法解压")
+        return []
+
+    return zip_source_s
+
+
+def download_json_flight(
+    flight_spider: FlightSpider, manifest: FlightManifest, uid_8, front_name, **kwargs
+):
+    try:
+        output_file = flight_spider.download_load_by_uid8(uid_8, **kwargs)
+    except Exception as e:
+        manifest.mark_download_error(uid_8, repr(e))
+        raise
+
+    if output_file is None:
+        manifest.mark_download_error(uid_8, "返回数据为空或不是有效的JSON")
+    else:
+        # JSON模式下载完成即处理完成
+        output_size = os.path.getsize(output_file)
+        manifest.mark_downloaded(uid_8, output_size)
+        manifest.mark_processed(front_name, output_size, uid8=uid_8)
+
+
+def gen_csv_task_list(
+    whole_json_list,
+    added_ui8_set,
+    flight_spider: FlightSpider,
+    credential: Credential,
+    manifest: FlightManifest,
+    output_folder,
+    keep_archive=False,
+):
+    task_list = []
+    for json_list in whole_json_list:
+        # 先给一个压缩包的名字
+        data_zip = json_list["dataZip"].strip(".zip")
+        front_name = (
+            f"{data_zip}_{json_list['departureIcao']}_{json_list['arrivalIcao']}"
+        )
+        # 进行增量下载
+        if json_list["uid8"] in added_ui8_set:
+            file_name = os.path.join(output_folder, f"{front_name}.zip")
+            download_kwargs = {
+                "flight_spider": flight_spider,
+                "credential": credential,
+                "manifest": manifest,
+                "uid_8": json_list["uid8"],
+                "file_name": file_name,
+                "front_name": front_name,
+                "output_folder": output_folder,
+                "keep_archive": keep_archive,
+            }
+            task_list.append((front_name, download_kwargs))
+        else:
+            logger.info("%s.zip已经存在，跳过", front_name)
+
+    return task_list
+
+
+def record_process_result(
+    manifest: FlightManifest,
+    packer: ReleasePacker,
+    zip_file_header,
+    error,
+    output_folder,
+    output_suffix,
+    cache_key=None,
+    cache: ProcessingCache = None,
+):
+    # 每处理完一个文件就记录到manifest和缓存中，并交给压缩线程
+    if error is None:
+        output_file = os.path.join(output_folder, f"{zip_file_header}{output_suffix}")
+        manifest.mark_processed(
+            zip_file_header, os.path.getsize(output_file), cache_key=cache_key
+        )
+        if cache is not None:
+            cache.store(cache_key, output_file)
+        packer.add(output_file)
+    else:
+        manifest.mark_process_error(zip_file_header, error)
+
+
+def load_cached_results(
+    manifest: FlightManifest,
+    packer: ReleasePacker,
+    cache: ProcessingCache,
+    zip_source_s,
+    cache_key_dict,
+    output_folder,
+    output_suffix,
+):
+    """
+    缓存命中的文件直接取出结果，返回仍需处理的zip文件列表
+    """
+    if cache is None:
+        return zip_source_s
+
+    miss_zip_source_s = []
+    for zip_source in zip_source_s:
+        zip_file_header = get_pure_name_list([zip_source]).pop()
+        cache_key = cache_key_dict[zip_file_header]
+        output_file = os.path.join(output_folder, f"{zip_file_header}{output_suffix}")
+        if cache.load(cache_key, output_file):
+            logger.info("%s命中缓存，直接使用之前的处理结果", zip_file_header)
+            record_process_result(
+                manifest,
+                packer,
+                zip_file_header,
+                None,
+                output_folder,
+                output_suffix,
+                cache_key,
+            )
+        else:
+            miss_zip_source_s.append(zip_source)
+
+    return miss_zip_source_s
+
+
+def release_output_files(packer: ReleasePacker, output_folder, output_suffix):
+    # 之前运行遗留在输出文件夹中的文件也一起压缩
+    for output_file in glob.glob(os.path.join(output_folder, f"*{output_suffix}")):
+        packer.add(output_file)
+    volume_list = packer.close()
+    logger.info("输出文件全部压缩到Archive目录: %s", volume_list)
+
+    shutil.rmtree(output_folder)
+    logger.info("删除%s目录本身", output_folder)
+
+
 @click.group(chain=True)
 def cli():
     pass
@@ -71,7 +272,7 @@ def cli():
     "--config-dir",
     show_default=True,
     default="./configs",
-    help="配置文件夹路径，里面含有list.json(包含所有已下载运营数据信息)，need_vars.csv(包含需要参数的信息)",
+    help="配置文件夹路径，里面含有manifest.db(记录所有航班的下载、处理状态)，need_vars.csv(包含需要参数的信息)",
 )
 @click.option(
     "-o",
@@ -84,7 +285,68 @@ def cli():
 @click.option(
     "-t", "--file-type", type=click.Choice(["JSON", "CSV"], case_sensitive=False)
 )
-def download_files(user, password, config_dir, output_folder, file_type, log):
+@click.option(
+    "--output-format",
+    type=click.Choice(["TSV", "Parquet", "Feather", "NPZ"], case_sensitive=False),
+    show_default=True,
+    default="TSV",
+    help="JSON模式下处理后文件的输出格式，TSV为制表符分隔的txt文件，其余为带压缩的列式二进制格式",
+)
+@click.option(
+    "--keep-raw",
+    is_flag=True,
+    default=False,
+    help="JSON模式下是否保留服务器返回的原始数据，保留时直接存储为.json.gz压缩文件",
+)
+@click.option(
+    "--compact-dtypes",
+    is_flag=True,
+    default=False,
+    help="按配置文件夹中var_dtypes.csv的参数数据类型保存参数，连续参数可用float32、离散参数可用小整数，减少内存占用和输出大小",
+)
+@click.option(
+    "--keep-archive",
+    is_flag=True,
+    default=False,
+    help="CSV模式下保留下载的压缩包而不解压，process时直接从压缩包中读取数据，每个航班只写一次磁盘",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    show_default=True,
+    default=4,
+    type=click.IntRange(min=1),
+    help="同时下载的航班数量，也用于并发获取航班列表",
+)
+@click.option(
+    "--page-size",
+    show_default=True,
+    default=100,
+    type=click.IntRange(min=1),
+    help="获取航班列表时每页的航班数量，服务器允许时可以调大以减少请求次数",
+)
+@click.option(
+    "--list-mode",
+    type=click.Choice(["Incremental", "Full"], case_sensitive=False),
+    show_default=True,
+    default="Incremental",
+    help="航班列表获取方式，Incremental只获取上次之后新增的航班，Full重新获取全部航班列表，建议定期使用Full进行全量核对",
+)
+def download_files(
+    user,
+    password,
+    config_dir,
+    output_folder,
+    file_type,
+    log,
+    output_format,
+    keep_raw,
+    compact_dtypes,
+    keep_archive,
+    jobs,
+    page_size,
+    list_mode,
+):
     # 创建文件夹
     folder_creator(output_folder)
     # 创建log文件夹
@@ -99,11 +361,16 @@ def download_files(user, password, config_dir, output_folder, file_type, log):
         filemode="w",
     )
 
+    manifest = FlightManifest(os.path.join(config_dir, "manifest.db"))
     downloaded_list = os.path.join(config_dir, "list.json")
+    if not manifest.has_flights() and os.path.exists(downloaded_list):
+        # 兼容旧版本，将list.json中的航班导入manifest
+        manifest.import_json_list(downloaded_list)
 
-    chrome, token, cookie = chrome_runner(user, password)
-    # 爬取所有的list
-    flight_spider = FlightSpider()
+    credential = Credential(user, password)
+    chrome, token, cookie = credential.chrome, credential.token, credential.cookie
+    # 爬取所有的list，并发下载时共用连接池
+    flight_spider = FlightSpider(pool_size=jobs)
 
     # 预先进行文件夹变换
     time.sleep(10)
@@ -112,11 +379,15 @@ def download_files(user, password, config_dir, output_folder, file_type, log):
 
     # 获取所有运营数据列表和需要下载的uid8列表,并临时将所有运营数据列表储存在本地
     chrome, added_ui8_set, whole_json_list = json_compare(
-        chrome, flight_spider, downloaded_list, token, cookie
+        chrome,
+        flight_spider,
+        manifest,
+        token,
+        cookie,
+        page_size=page_size,
+        jobs=jobs,
+        list_mode=list_mode,
     )
-    # 临时储存结果到本地
-    with open(os.path.join(log, "temp.json"), "w") as f:
-        json.dump(json.loads(json.dumps(whole_json_list)), f)
 
     if file_type.lower() == "JSON".lower():
         folder_creator(os.path.join(output_folder, "TXT"))
@@ -124,51 +395,48 @@ def download_files(user, password, config_dir, output_folder, file_type, log):
         # 遍历已经下好的文件
         need_vars = get_need_vars_from_csv(os.path.join(config_dir, "need_vars.csv"))
         need_vars_str = ",".join(need_vars)
+        # 参数数据类型配置，与need_vars.csv放在同一个配置文件夹中
+        var_dtypes = None
+        if compact_dtypes:
+            var_dtypes = get_var_dtypes_from_csv(
+                os.path.join(config_dir, "var_dtypes.csv")
+            )
+        task_list = []
         for json_list in whole_json_list:
             front_name = f"{json_list['acReg']}_{json_list['uid8']}"
             if json_list["uid8"] in added_ui8_set:
                 file_name = os.path.join(output_folder, "TXT", front_name)
-                flight_spider.download_load_by_uid8(
-                    json_list["uid8"],
-                    token=token,
-                    cookie=cookie,
-                    path=file_name,
-                    need_vars=need_vars_str,
-                )
+                download_kwargs = {
+                    "flight_spider": flight_spider,
+                    "manifest": manifest,
+                    "uid_8": json_list["uid8"],
+                    "front_name": front_name,
+                    "token": token,
+                    "cookie": cookie,
+                    "path": file_name,
+                    "need_vars": need_vars_str,
+                    "output_format": output_format,
+                    "keep_raw": keep_raw,
+                    "var_dtypes": var_dtypes,
+                }
+                task_list.append((front_name, download_kwargs))
             else:
-                logger.info("%s.txt已经存在，跳过", front_name)
+                logger.info("%s已经存在，跳过", front_name)
+
+        download_concurrently(download_json_flight, task_list, jobs)
     elif file_type.lower() == "CSV".lower():
-        for json_list in whole_json_list:
-            # 先给一个压缩包的名字
-            data_zip = json_list["dataZip"].strip(".zip")
-            front_name = (
-                f"{data_zip}_{json_list['departureIcao']}_{json_list['arrivalIcao']}"
-            )
-            # 进行增量下载
-            if json_list["uid8"] in added_ui8_set:
-                file_name = os.path.join(output_folder, f"{front_name}.zip")
-                try:
-                    flight_spider.download_by_uid8(
-                        json_list["uid8"], token=token, cookie=cookie, path=file_name
-                    )
-                except requests.HTTPError as e:
-                    logger.warning("出现%s, 可能cookies过期，尝试重新获取cookies", e)
-                    chrome, token, cookie = chrome_runner(user, password)
-                    flight_spider.download_by_uid8(
-                        json_list["uid8"], token=token, cookie=cookie, path=file_name
-                    )
-
-                # 提取zip文件
-                try:
-                    extract_zip(file_name, output_folder)
-                except:
-                    logger.error("%s.zip无法解压，跳过", front_name)
-            else:
-                logger.info("%s.zip已经存在，跳过", front_name)
+        task_list = gen_csv_task_list(
+            whole_json_list,
+            added_ui8_set,
+            flight_spider,
+            credential,
+            manifest,
+            output_folder,
+            keep_archive=keep_archive,
+        )
+        download_concurrently(download_csv_flight, task_list, jobs)
 
-    # 当前面的全部执行完毕后，存储最新的可下载数据list
-    with open(downloaded_list, "w") as f:
-        json.dump(json.loads(json.dumps(whole_json_list)), f)
+    manifest.close()
 
 
 @cli.command("process")
@@ -177,7 +445,7 @@ def download_files(user, password, config_dir, output_folder, file_type, log):
     "--config-dir",
     show_default=True,
     default="./configs",
-    help="配置文件夹路径，里面含有list.json(包含所有已下载运营数据信息)，need_vars.csv(包含需要参数的信息)",
+    help="配置文件夹路径，里面含有manifest.db(记录所有航班的下载、处理状态)，need_vars.csv(包含需要参数的信息)",
 )
 @click.option(
     "-o",
@@ -201,7 +469,111 @@ def download_files(user, password, config_dir, output_folder, file_type, log):
     help="归档文件路径，用于指明之前处理的文件储存路径，避免重复输出，包含了zip存档和txt存档，在所有转换完成后，程序自动将文件移动到archive中",
 )
 @click.option("--log", show_default=True, default="./logs", help="logs日志文件储存目录")
-def preprocess(config_dir, output_folder, input_folder, archive_folder, log):
+@click.option(
+    "--output-format",
+    type=click.Choice(["TSV", "Parquet", "Feather", "NPZ"], case_sensitive=False),
+    show_default=True,
+    default="TSV",
+    help="处理后文件的输出格式，TSV为制表符分隔的txt文件，其余为带压缩的列式二进制格式",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    help="处理进程数量，默认为CPU核数",
+)
+@click.option(
+    "--chunksize",
+    show_default=True,
+    default=1,
+    type=click.IntRange(min=1),
+    help="每次分配给处理进程的文件数量，文件很多且很小时可以调大以减少进程间通信",
+)
+@click.option(
+    "--memory-budget",
+    type=click.IntRange(min=1),
+    help="同时处理的文件解压后总大小上限(MB)，大文件过多时限制并发，不设置则不限制",
+)
+@click.option(
+    "--stage-timing",
+    is_flag=True,
+    default=False,
+    help="统计每个文件各处理阶段的耗时和数据量，结束时输出汇总表格",
+)
+@click.option(
+    "--profile-file",
+    help="用cProfile分析指定文件(不含后缀的zip文件名)的处理过程，结果保存到log目录下的同名.prof文件",
+)
+@click.option(
+    "--volume-size",
+    show_default=True,
+    default=50,
+    type=click.IntRange(min=1),
+    help="输出文件压缩包的分卷大小(MB)，每个分卷都是可以单独解压的zip文件",
+)
+@click.option(
+    "--release-jobs",
+    show_default=True,
+    default=4,
+    type=click.IntRange(min=1),
+    help="压缩输出文件的线程数量，边处理边压缩",
+)
+@click.option(
+    "--release-compression",
+    type=click.Choice(["Deflate", "LZMA", "BZIP2"], case_sensitive=False),
+    show_default=True,
+    default="Deflate",
+    help="输出文件压缩包的压缩算法，LZMA压缩率更高但更慢",
+)
+@click.option(
+    "--cache-folder",
+    show_default=True,
+    default="./C919_data/Cache",
+    help="处理结果缓存路径，zip内容、need_vars参数、输出格式和处理版本都不变时直接复用",
+)
+@click.option(
+    "--cache-size",
+    show_default=True,
+    default=10240,
+    type=click.IntRange(min=0),
+    help="缓存总大小上限(MB)，超过时删除最久未使用的条目，为0时不使用缓存",
+)
+@click.option(
+    "--channel-store",
+    help="通道存储路径，设置后每个zip只解析一次，按原始采样率逐个参数保存为压缩的npz文件，之后增加参数时只读取需要的参数",
+)
+@click.option(
+    "--store-vars",
+    "store_vars_file",
+    help="通道存储中保存的参数列表文件，格式同need_vars.csv，不设置则保存表头中的全部参数",
+)
+@click.option(
+    "--compact-dtypes",
+    is_flag=True,
+    default=False,
+    help="按配置文件夹中var_dtypes.csv的参数数据类型保存参数，连续参数可用float32、离散参数可用小整数，减少内存占用和输出大小",
+)
+def preprocess(
+    config_dir,
+    output_folder,
+    input_folder,
+    archive_folder,
+    log,
+    output_format,
+    jobs,
+    chunksize,
+    memory_budget,
+    stage_timing,
+    profile_file,
+    volume_size,
+    release_jobs,
+    release_compression,
+    cache_folder,
+    cache_size,
+    channel_store,
+    store_vars_file,
+    compact_dtypes,
+):
     folder_creator(output_folder)
     folder_creator(archive_folder)
     folder_creator(log)
@@ -218,57 +590,614 @@ def preprocess(config_dir, output_folder, input_folder, archive_folder, log):
     )
 
     zip_file_s = glob.glob(os.path.join(input_folder, "*.zip"))
-    txt_file_1 = glob.glob(os.path.join(output_folder, "*.txt"))
-    txt_file_2 = glob.glob(os.path.join(archive_folder, "*.zip"))
-    txt_file_s = txt_file_1 + txt_file_2
-    # 生成已经前处理完成的列表，方便接下来进行对比
-    txt_file_s = get_pure_name_list(txt_file_s)
+    output_suffix = get_output_suffix(output_format)
+    manifest = FlightManifest(os.path.join(config_dir, "manifest.db"))
+    if not manifest.has_files():
+        # 兼容旧版本，将输出和归档文件夹中已有的文件导入manifest
+        txt_file_1 = glob.glob(os.path.join(output_folder, f"*{output_suffix}"))
+        txt_file_2 = glob.glob(os.path.join(archive_folder, "*.zip"))
+        manifest.import_done_files(get_pure_name_list(txt_file_1 + txt_file_2))
+    # 从manifest中获取已经前处理完成的列表及其缓存键，方便接下来进行对比
+    done_cache_key_dict = manifest.get_done_cache_key_dict()
     need_vars = get_need_vars_from_csv(os.path.join(config_dir, "need_vars.csv"))
+    # 通道存储中保存的参数，need_vars中的参数总是一并保存
+    store_vars = None
+    if store_vars_file is not None:
+        store_vars = get_need_vars_from_csv(store_vars_file)
+    # 参数数据类型配置，与need_vars.csv放在同一个配置文件夹中
+    var_dtypes = None
+    if compact_dtypes:
+        var_dtypes = get_var_dtypes_from_csv(
+            os.path.join(config_dir, "var_dtypes.csv")
+        )
+    # 未解压的下载压缩包展开为其中的每个zip文件
+    zip_source_s = expand_zip_sources(zip_file_s)
+    # 处理过且缓存键不变的文件直接跳过，不再交给处理进程
+    todo_zip_source_s, cache_key_dict = select_todo_zip_sources(
+        zip_source_s, done_cache_key_dict, need_vars, output_format, var_dtypes
+    )
+    logger.info(
+        "共%s个文件，其中%s个已经处理过，跳过",
+        len(zip_source_s),
+        len(zip_source_s) - len(todo_zip_source_s),
+    )
+    # 缓存键由zip内容指纹、参数列表、输出格式和处理版本决定
+    cache = None
+    if cache_size > 0:
+        cache = ProcessingCache(cache_folder, cache_size * 1024 * 1024)
 
-    total = len(zip_file_s)
-
-    cores = multiprocessing.cpu_count()
-    with newpool(processes=cores) as p:
-        r = list(
-            tqdm.tqdm(
-                p.imap(
-                    process_zip_to_txt,
-                    zip_file_s,
-                    repeat(txt_file_s),
-                    repeat(need_vars),
-                    repeat(output_folder),
-                ),
-                total=total,
+    total = len(todo_zip_source_s)
+
+    cores = jobs or multiprocessing.cpu_count()
+    r = []
+    stage_stats_list = []
+    # 共用的只读参数通过initializer在每个进程中只传递一次，结果按完成顺序返回
+    with newpool(
+        processes=cores,
+        initializer=init_process_worker,
+        initargs=(
+            need_vars,
+            output_folder,
+            output_format,
+            stage_timing,
+            profile_file,
+            os.path.join(log, f"{profile_file}.prof"),
+            channel_store,
+            store_vars,
+            var_dtypes,
+        ),
+    ) as p:
+        # 处理完成的文件立即交给压缩线程，在进程池创建之后启动线程
+        packer = ReleasePacker(
+            os.path.join(archive_folder, "TXT"),
+            f"Release_{var_date.year}_{var_date.month}_{var_date.day}",
+            volume_size=volume_size * 1024 * 1024,
+            jobs=release_jobs,
+            compression=release_compression,
+        )
+        # 缓存命中的文件直接取出结果
+        miss_zip_source_s = load_cached_results(
+            manifest,
+            packer,
+            cache,
+            todo_zip_source_s,
+            cache_key_dict,
+            output_folder,
+            output_suffix,
+        )
+        # 按解压后大小从大到小处理
+        zip_size_s = sort_zip_sources_by_size(miss_zip_source_s)
+        if memory_budget is None:
+            results = p.uimap(
+                process_zip_in_worker,
+                [zip_source for zip_source, _ in zip_size_s],
+                chunksize=chunksize,
             )
+        else:
+            results = iter_results_within_budget(
+                p, zip_size_s, cores, memory_budget * 1024 * 1024
+            )
+        pb = tqdm.tqdm(results, total=total, initial=total - len(zip_size_s))
+        for zip_file_header, error, stage_stats in pb:
+            r.append(zip_file_header)
+            stage_stats_list.append(stage_stats)
+            record_process_result(
+                manifest,
+                packer,
+                zip_file_header,
+                error,
+                output_folder,
+                output_suffix,
+                cache_key_dict[zip_file_header],
+                cache,
+            )
+
+    logger.info("转换成功的文件：%s", r)
+
+    if stage_timing:
+        stage_report = format_stage_report(stage_stats_list)
+        print(stage_report)
+        logger.info("各阶段耗时统计:\n%s", stage_report)
+
+    # 转移文件到archive文件夹，直接从archive文件夹重新处理时无需转移
+    for zip_file in zip_file_s:
+        if os.path.abspath(os.path.dirname(zip_file)) != os.path.abspath(
+            archive_folder
+        ):
+            shutil.move(zip_file, archive_folder)
+    manifest.mark_archived(get_pure_name_list(zip_source_s))
+    manifest.close()
+    logger.info("zip文件全部转移到Archive目录：%s", archive_folder)
+
+    release_output_files(packer, output_folder, output_suffix)
+    if cache is not None:
+        cache.evict()
+
+
+@cli.command("pipeline")
+@click.option("-u", "--user", required=True, type=str, help="运营数据平台用户名")
+@click.option("-p", "--password", required=True, type=str, help="用户密码")
+@click.option(
+    "-d",
+    "--config-dir",
+    show_default=True,
+    default="./configs",
+    help="配置文件夹路径，里面含有manifest.db(记录所有航班的下载、处理状态)，need_vars.csv(包含需要参数的信息)",
+)
+@click.option(
+    "-i",
+    "--input-folder",
+    show_default=True,
+    default="./C919_data",
+    help="下载文件储存路径，同时也是处理的输入文件路径",
+)
+@click.option(
+    "-o",
+    "--output-folder",
+    show_default=True,
+    default="./C919_data/TXT",
+    help="输出文件路径",
+)
+@click.option(
+    "-a",
+    "--archive-folder",
+    show_default=True,
+    default="./C919_data/Archive",
+    help="归档文件路径，在所有转换完成后，程序自动将文件移动到archive中",
+)
+@click.option("--log", show_default=True, default="./logs", help="logs日志文件储存目录")
+@click.option(
+    "--output-format",
+    type=click.Choice(["TSV", "Parquet", "Feather", "NPZ"], case_sensitive=False),
+    show_default=True,
+    default="TSV",
+    help="处理后文件的输出格式，TSV为制表符分隔的txt文件，其余为带压缩的列式二进制格式",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    show_default=True,
+    default=4,
+    type=click.IntRange(min=1),
+    help="同时下载的航班数量，也用于并发获取航班列表",
+)
+@click.option(
+    "--process-jobs",
+    type=click.IntRange(min=1),
+    help="处理进程数量，默认为CPU核数",
+)
+@click.option(
+    "--queue-size",
+    show_default=True,
+    default=16,
+    type=click.IntRange(min=1),
+    help="下载与处理之间最多积压的zip文件数量，积压满时下载线程等待处理进度",
+)
+@click.option(
+    "--keep-archive",
+    is_flag=True,
+    default=False,
+    help="保留下载的压缩包而不解压，处理进程直接从压缩包中读取数据，每个航班只写一次磁盘",
+)
+@click.option(
+    "--stage-timing",
+    is_flag=True,
+    default=False,
+    help="统计每个文件各处理阶段的耗时和数据量，结束时输出汇总表格",
+)
+@click.option(
+    "--profile-file",
+    help="用cProfile分析指定文件(不含后缀的zip文件名)的处理过程，结果保存到log目录下的同名.prof文件",
+)
+@click.option(
+    "--volume-size",
+    show_default=True,
+    default=50,
+    type=click.IntRange(min=1),
+    help="输出文件压缩包的分卷大小(MB)，每个分卷都是可以单独解压的zip文件",
+)
+@click.option(
+    "--release-jobs",
+    show_default=True,
+    default=4,
+    type=click.IntRange(min=1),
+    help="压缩输出文件的线程数量，边处理边压缩",
+)
+@click.option(
+    "--release-compression",
+    type=click.Choice(["Deflate", "LZMA", "BZIP2"], case_sensitive=False),
+    show_default=True,
+    default="Deflate",
+    help="输出文件压缩包的压缩算法，LZMA压缩率更高但更慢",
+)
+@click.option(
+    "--cache-folder",
+    show_default=True,
+    default="./C919_data/Cache",
+    help="处理结果缓存路径，zip内容、need_vars参数、输出格式和处理版本都不变时直接复用",
+)
+@click.option(
+    "--cache-size",
+    show_default=True,
+    default=10240,
+    type=click.IntRange(min=0),
+    help="缓存总大小上限(MB)，超过时删除最久未使用的条目，为0时不使用缓存",
+)
+@click.option(
+    "--channel-store",
+    help="通道存储路径，设置后每个zip只解析一次，按原始采样率逐个参数保存为压缩的npz文件，之后增加参数时只读取需要的参数",
+)
+@click.option(
+    "--store-vars",
+    "store_vars_file",
+    help="通道存储中保存的参数列表文件，格式同need_vars.csv，不设置则保存表头中的全部参数",
+)
+@click.option(
+    "--compact-dtypes",
+    is_flag=True,
+    default=False,
+    help="按配置文件夹中var_dtypes.csv的参数数据类型保存参数，连续参数可用float32、离散参数可用小整数，减少内存占用和输出大小",
+)
+@click.option(
+    "--page-size",
+    show_default=True,
+    default=100,
+    type=click.IntRange(min=1),
+    help="获取航班列表时每页的航班数量，服务器允许时可以调大以减少请求次数",
+)
+@click.option(
+    "--list-mode",
+    type=click.Choice(["Incremental", "Full"], case_sensitive=False),
+    show_default=True,
+    default="Incremental",
+    help="航班列表获取方式，Incremental只获取上次之后新增的航班，Full重新获取全部航班列表",
+)
+def pipeline(
+    user,
+    password,
+    config_dir,
+    input_folder,
+    output_folder,
+    archive_folder,
+    log,
+    output_format,
+    jobs,
+    process_jobs,
+    queue_size,
+    keep_archive,
+    stage_timing,
+    profile_file,
+    volume_size,
+    release_jobs,
+    release_compression,
+    cache_folder,
+    cache_size,
+    channel_store,
+    store_vars_file,
+    compact_dtypes,
+    page_size,
+    list_mode,
+):
+    """
+    CSV模式下边下载边处理：每个航班下载解压完成后立即交给处理进程池
+    """
+    folder_creator(input_folder)
+    folder_creator(output_folder)
+    folder_creator(archive_folder)
+    folder_creator(log)
+
+    var_date = datetime.datetime.today()
+    logging.basicConfig(
+        filename=os.path.join(
+            log, f"pipeline_{var_date.year}_{var_date.month}_{var_date.day}.log"
+        ),
+        level=logging.INFO,
+        filemode="w",
+    )
+
+    output_suffix = get_output_suffix(output_format)
+    manifest = FlightManifest(os.path.join(config_dir, "manifest.db"))
+    downloaded_list = os.path.join(config_dir, "list.json")
+    if not manifest.has_flights() and os.path.exists(downloaded_list):
+        # 兼容旧版本，将list.json中的航班导入manifest
+        manifest.import_json_list(downloaded_list)
+    if not manifest.has_files():
+        # 兼容旧版本，将输出和归档文件夹中已有的文件导入manifest
+        txt_file_1 = glob.glob(os.path.join(output_folder, f"*{output_suffix}"))
+        txt_file_2 = glob.glob(os.path.join(archive_folder, "*.zip"))
+        manifest.import_done_files(get_pure_name_list(txt_file_1 + txt_file_2))
+    done_cache_key_dict = manifest.get_done_cache_key_dict()
+    need_vars = get_need_vars_from_csv(os.path.join(config_dir, "need_vars.csv"))
+    # 通道存储中保存的参数，need_vars中的参数总是一并保存
+    store_vars = None
+    if store_vars_file is not None:
+        store_vars = get_need_vars_from_csv(store_vars_file)
+    # 参数数据类型配置，与need_vars.csv放在同一个配置文件夹中
+    var_dtypes = None
+    if compact_dtypes:
+        var_dtypes = get_var_dtypes_from_csv(os.path.join(config_dir, "var_dtypes.csv"))
+    # 缓存键由zip内容指纹、参数列表、输出格式和处理版本决定
+    cache = None
+    if cache_size > 0:
+        cache = ProcessingCache(cache_folder, cache_size * 1024 * 1024)
+
+    credential = Credential(user, password)
+    chrome, token, cookie = credential.chrome, credential.token, credential.cookie
+    flight_spider = FlightSpider(pool_size=jobs)
+
+    chrome, added_ui8_set, whole_json_list = json_compare(
+        chrome,
+        flight_spider,
+        manifest,
+        token,
+        cookie,
+        page_size=page_size,
+        jobs=jobs,
+        list_mode=list_mode,
+    )
+
+    task_list = gen_csv_task_list(
+        whole_json_list,
+        added_ui8_set,
+        flight_spider,
+        credential,
+        manifest,
+        input_folder,
+        keep_archive=keep_archive,
+    )
+
+    # 上次遗留在输入文件夹中尚未处理的zip文件先处理
+    leftover_zip_source_s = expand_zip_sources(
+        glob.glob(os.path.join(input_folder, "*.zip"))
+    )
+    zip_source_s = []
+    # 有界队列：处理跟不上时下载线程阻塞等待，避免解压文件无限堆积
+    zip_queue = queue.Queue(maxsize=queue_size)
+
+    def download_to_queue(**kwargs):
+        for zip_source in download_csv_flight(**kwargs):
+            zip_queue.put(zip_source)
+
+    def download_stage():
+        try:
+            download_concurrently(download_to_queue, task_list, jobs)
+        finally:
+            # 下载全部结束后放入None通知处理阶段
+            zip_queue.put(None)
+
+    cores = process_jobs or multiprocessing.cpu_count()
+    # 每个进程最多预留两个任务，其余zip文件留在队列中
+    max_pending = cores * 2
+    pending = deque()
+    r = []
+    stage_stats_list = []
+    cache_key_dict = {}
+
+    def collect_result(result):
+        zip_file_header, error, stage_stats = result.get()
+        r.append(zip_file_header)
+        stage_stats_list.append(stage_stats)
+        record_process_result(
+            manifest,
+            packer,
+            zip_file_header,
+            error,
+            output_folder,
+            output_suffix,
+            cache_key_dict[zip_file_header],
+            cache,
+        )
+        pb.update(1)
+
+    # 先创建进程池再启动下载线程，避免在多线程状态下fork
+    with newpool(
+        processes=cores,
+        initializer=init_process_worker,
+        initargs=(
+            need_vars,
+            output_folder,
+            output_format,
+            stage_timing,
+            profile_file,
+            os.path.join(log, f"{profile_file}.prof"),
+            channel_store,
+            store_vars,
+            var_dtypes,
+        ),
+    ) as p:
+        # 处理完成的文件立即交给压缩线程，在进程池创建之后启动线程
+        packer = ReleasePacker(
+            os.path.join(archive_folder, "TXT"),
+            f"Release_{var_date.year}_{var_date.month}_{var_date.day}",
+            volume_size=volume_size * 1024 * 1024,
+            jobs=release_jobs,
+            compression=release_compression,
         )
+        download_thread = threading.Thread(target=download_stage, daemon=True)
+        download_thread.start()
+        with tqdm.tqdm(desc="航班处理进度", total=0, position=1) as pb:
+            for zip_source in chain(leftover_zip_source_s, iter(zip_queue.get, None)):
+                zip_source_s.append(zip_source)
+                todo_zip_source_s, todo_cache_key_dict = select_todo_zip_sources(
+                    [zip_source],
+                    done_cache_key_dict,
+                    need_vars,
+                    output_format,
+                    var_dtypes,
+                )
+                cache_key_dict.update(todo_cache_key_dict)
+                todo_zip_source_s = load_cached_results(
+                    manifest,
+                    packer,
+                    cache,
+                    todo_zip_source_s,
+                    cache_key_dict,
+                    output_folder,
+                    output_suffix,
+                )
+                if not todo_zip_source_s:
+                    logger.info("%s已经处理过，跳过", zip_source)
+                    continue
+
+                pending.append(p.apipe(process_zip_in_worker, zip_source))
+                pb.total += 1
+                pb.refresh()
+                while pending and (len(pending) >= max_pending or pending[0].ready()):
+                    collect_result(pending.popleft())
+
+            while pending:
+                collect_result(pending.popleft())
+        download_thread.join()
 
     logger.info("转换成功的文件：%s", r)
 
-    # 转移文件到archive文件夹
+    if stage_timing:
+        stage_report = format_stage_report(stage_stats_list)
+        print(stage_report)
+        logger.info("各阶段耗时统计:\n%s", stage_report)
+
+    # 转移文件到archive文件夹，同一压缩包中的多个zip文件只移动一次
+    zip_file_s = {
+        zip_source[0] if isinstance(zip_source, tuple) else zip_source: None
+        for zip_source in zip_source_s
+    }
     for zip_file in zip_file_s:
         shutil.move(zip_file, archive_folder)
+    manifest.mark_archived(get_pure_name_list(zip_source_s))
+    manifest.close()
     logger.info("zip文件全部转移到Archive目录：%s", archive_folder)
 
-    # 调用7zip对文件进行压缩
-    seven_zip_name = f"Release_{var_date.year}_{var_date.month}_{var_date.day}.7z"
-    seven_zip_path = os.path.join(output_folder, seven_zip_name)
-    if sys.platform.startswith("darwin"):
-        seven_zip = "7zz"
-    elif sys.platform.startswith("win"):
-        seven_zip = "7z.exe"
-    cmd = [seven_zip, "a", "-v50m", f"{seven_zip_path}", f"{output_folder}/*.txt"]
-    subprocess.run(cmd, check=False)
-
-    # 转移生成的7zip文件到Archive文件夹
-    seven_zip_file_s = glob.glob(os.path.join(output_folder, "*.7z*"))
-    for seven_zip_file in seven_zip_file_s:
-        archive_txt_folder = os.path.join(archive_folder, "TXT")
-        folder_creator(archive_txt_folder)
-        shutil.move(seven_zip_file, archive_txt_folder)
-    logger.info("7z(将TXT文件压缩)文件全部转移到Archive目录: %s", archive_folder)
+    release_output_files(packer, output_folder, output_suffix)
+    if cache is not None:
+        cache.evict()
 
-    shutil.rmtree(output_folder)
-    logger.info("删除%s目录本身", output_folder)
+
+@cli.command("fleet-build")
+@click.option(
+    "-d",
+    "--config-dir",
+    show_default=True,
+    default="./configs",
+    help="配置文件夹路径，从其中的manifest.db获取每个文件对应航班的uid8、机号和起降机场",
+)
+@click.option(
+    "-s",
+    "--store-folder",
+    show_default=True,
+    default="./C919_data/Fleet",
+    help="机队存储路径",
+)
+@click.option(
+    "-i",
+    "--input-path",
+    multiple=True,
+    default=("./C919_data/TXT", "./C919_data/Archive/TXT"),
+    show_default=True,
+    help="处理后的输出文件夹、输出文件或Release分卷，可以指定多次",
+)
+@click.option("--log", show_default=True, default="./logs", help="logs日志文件储存目录")
+def fleet_build(config_dir, store_folder, input_path, log):
+    """
+    把处理后的输出文件加入机队存储，已经加入的航班跳过，重新处理过的航班替换
+    """
+    folder_creator(log)
+    var_date = datetime.datetime.today()
+    logging.basicConfig(
+        filename=os.path.join(
+            log, f"fleet_{var_date.year}_{var_date.month}_{var_date.day}.log"
+        ),
+        level=logging.INFO,
+    )
+
+    manifest = FlightManifest(os.path.join(config_dir, "manifest.db"))
+    file_flight_dict = manifest.get_file_flight_dict()
+    file_cache_key_dict = manifest.get_file_cache_key_dict()
+    manifest.close()
+
+    store = FleetStore(store_folder)
+    input_path_s = [path for path in input_path if os.path.exists(path)]
+    with tqdm.tqdm(desc="加入机队存储") as pb:
+        added = build_fleet_store(
+            store, input_path_s, file_flight_dict, file_cache_key_dict, pb=pb
+        )
+    logger.info("共加入%s个航班，机队存储共%s行", added, store.total_rows)
+    print(f"共加入{added}个航班")
+    store.close()
+
+
+@cli.command("fleet-query")
+@click.option(
+    "-s",
+    "--store-folder",
+    show_default=True,
+    default="./C919_data/Fleet",
+    help="机队存储路径",
+)
+@click.option("-c", "--channel", multiple=True, help="需要的参数，可以指定多次")
+@click.option("--uid8", multiple=True, help="航班uid8，可以指定多次")
+@click.option("--ac-reg", multiple=True, help="机号，如B-XXXX，可以指定多次")
+@click.option("--departure", multiple=True, help="起飞机场ICAO代码，可以指定多次")
+@click.option("--arrival", multiple=True, help="到达机场ICAO代码，可以指定多次")
+@click.option("--date-from", help="起始日期(含)，格式为YYYY-MM-DD")
+@click.option("--date-to", help="结束日期(含)，格式为YYYY-MM-DD")
+@click.option("-o", "--output-file", help="查询结果保存路径，不指定时只输出航班列表")
+@click.option(
+    "--output-format",
+    type=click.Choice(["TSV", "Parquet", "Feather", "NPZ"], case_sensitive=False),
+    show_default=True,
+    default="TSV",
+    help="查询结果的保存格式",
+)
+def fleet_query(
+    store_folder,
+    channel,
+    uid8,
+    ac_reg,
+    departure,
+    arrival,
+    date_from,
+    date_to,
+    output_file,
+    output_format,
+):
+    """
+    按航班索引跨航班查询参数，只读取选中航班的需要参数
+    """
+    store = FleetStore(store_folder)
+    filters = {
+        "date_from": date_from,
+        "date_to": date_to,
+        "uid8": uid8,
+        "ac_reg": ac_reg,
+        "departure_icao": departure,
+        "arrival_icao": arrival,
+    }
+    if output_file is None:
+        flights = store.find_flights(**filters)
+        for flight in flights:
+            print(
+                flight["flight_date"],
+                flight["ac_reg"],
+                flight["uid8"],
+                f"{flight['departure_icao']}-{flight['arrival_icao']}",
+                flight["zip_name"],
+                f"{flight['row_count']}行",
+                sep="\t",
+            )
+        print(f"共{len(flights)}个航班")
+    else:
+        if not channel:
+            raise click.UsageError("保存查询结果时需要用-c指定参数")
+        try:
+            dataframe = store.query_dataframe(channel, **filters)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        save_dataframe(dataframe, output_file, output_format)
+        print(
+            f"共{dataframe['zip_name'].nunique()}个航班，{len(dataframe)}行，"
+            f"已保存到{output_file}"
+        )
+    store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,247 @@
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    uid8 TEXT PRIMARY KEY,
+    ac_reg TEXT,
+    departure_icao TEXT,
+    arrival_icao TEXT,
+    flight_info TEXT NOT NULL,
+    list_order INTEGER,
+    listed_at TEXT,
+    downloaded_at TEXT,
+    download_size INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_flights_list_order ON flights (list_order);
+CREATE INDEX IF NOT EXISTS idx_flights_downloaded_at ON flights (downloaded_at);
+
+CREATE TABLE IF NOT EXISTS files (
+    zip_name TEXT PRIMARY KEY,
+    uid8 TEXT REFERENCES flights (uid8),
+    processed_at TEXT,
+    output_size INTEGER,
+    cache_key TEXT,
+    archived_at TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_files_uid8 ON files (uid8);
+"""
+
+# 旧版本数据库中缺少的列，打开时自动补上
+MANIFEST_MIGRATIONS = {
+    "files": {"cache_key": "TEXT"},
+}
+
+
+def get_now_str():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+class FlightManifest:
+    """
+    以uid8为主键记录每个航班的获取、下载、处理和归档状态，
+    files表记录每个待处理zip文件(以文件名为主键)对应的uid8和处理状态
+    """
+
+    def __init__(self, db_file):
+        # 下载线程会并发更新，所有操作都加锁，每次更新单独提交
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._lock, self._conn:
+            self._conn.executescript(MANIFEST_SCHEMA)
+            for table, columns in MANIFEST_MIGRATIONS.items():
+                exist_columns = {
+                    row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")
+                }
+                for column, column_type in columns.items():
+                    if column not in exist_columns:
+                        self._conn.execute(
+                            f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+                        )
+
+    def close(self):
+        self._conn.close()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, parameters).fetchall()
+
+    def _executemany(self, sql, seq_of_parameters):
+        with self._lock, self._conn:
+            self._conn.executemany(sql, seq_of_parameters)
+
+    def has_flights(self):
+        return bool(self._execute("SELECT 1 FROM flights LIMIT 1"))
+
+    def has_files(self):
+        return bool(self._execute("SELECT 1 FROM files LIMIT 1"))
+
+    def update_listed(self, whole_json_list):
+        now_str = get_now_str()
+        self._executemany(
+            """
+            INSERT INTO flights (
+                uid8, ac_reg, departure_icao, arrival_icao,
+                flight_info, list_order, listed_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (uid8) DO UPDATE SET
+                ac_reg = excluded.ac_reg,
+                departure_icao = excluded.departure_icao,
+                arrival_icao = excluded.arrival_icao,
+                flight_info = excluded.flight_info,
+                list_order = excluded.list_order
+            """,
+            (
+                (
+                    flight_info["uid8"],
+                    flight_info.get("acReg"),
+                    flight_info.get("departureIcao"),
+                    flight_info.get("arrivalIcao"),
+                    json.dumps(flight_info, ensure_ascii=False),
+                    list_order,
+                    now_str,
+                )
+                for list_order, flight_info in enumerate(whole_json_list)
+            ),
+        )
+
+    def import_json_list(self, json_file):
+        # 从旧版list.json迁移：其中的航班均视为已经下载完成
+        with open(json_file, "r") as f:
+            old_json_list = json.load(f)
+
+        self.update_listed(old_json_list)
+        now_str = get_now_str()
+        self._executemany(
+            "UPDATE flights SET downloaded_at = ? WHERE uid8 = ?",
+            ((now_str, flight_info["uid8"]) for flight_info in old_json_list),
+        )
+        logger.info("从%s迁移了%s个航班", json_file, len(old_json_list))
+
+    def get_flight_list(self):
+        rows = self._execute(
+            "SELECT flight_info FROM flights ORDER BY list_order, listed_at"
+        )
+        return [json.loads(flight_info) for (flight_info,) in rows]
+
+    def get_pending_uid8_set(self):
+        # 已获取但尚未下载成功的航班，包括之前下载失败的航班
+        rows = self._execute("SELECT uid8 FROM flights WHERE downloaded_at IS NULL")
+        return {uid8 for (uid8,) in rows}
+
+    def mark_downloaded(self, uid8, download_size, zip_name_list=()):
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                UPDATE flights SET downloaded_at = ?, download_size = ?, error = NULL
+                WHERE uid8 = ?
+                """,
+                (get_now_str(), download_size, uid8),
+            )
+            self._conn.executemany(
+                """
+                INSERT INTO files (zip_name, uid8) VALUES (?, ?)
+                ON CONFLICT (zip_name) DO UPDATE SET uid8 = excluded.uid8
+                """,
+                ((zip_name, uid8) for zip_name in zip_name_list),
+            )
+
+    def mark_download_error(self, uid8, error):
+        self._execute("UPDATE flights SET error = ? WHERE uid8 = ?", (error, uid8))
+
+    def import_done_files(self, zip_name_set):
+        # 从旧版的输出/归档文件夹迁移：其中的文件均视为已经处理完成
+        now_str = get_now_str()
+        self._executemany(
+            """
+            INSERT INTO files (zip_name, processed_at) VALUES (?, ?)
+            ON CONFLICT (zip_name) DO NOTHING
+            """,
+            ((zip_name, now_str) for zip_name in zip_name_set),
+        )
+
+    def get_done_zip_name_set(self):
+        # 处理出错的文件即使已经归档也不算完成，下次仍会重新处理
+        rows = self._execute(
+            """
+            SELECT zip_name FROM files
+            WHERE (processed_at IS NOT NULL OR archived_at IS NOT NULL)
+                AND error IS NULL
+            """
+        )
+        return {zip_name for (zip_name,) in rows}
+
+    def get_done_cache_key_dict(self):
+        # 已经处理完成的文件及其处理时的缓存键，旧版本导入的文件缓存键为None，需要重新处理
+        rows = self._execute(
+            """
+            SELECT zip_name, cache_key FROM files
+            WHERE (processed_at IS NOT NULL OR archived_at IS NOT NULL)
+                AND error IS NULL
+            """
+        )
+        return dict(rows)
+
+    def get_file_cache_key_dict(self):
+        # 处理完成的文件最近一次处理时的缓存键，没有缓存键的文件不返回
+        rows = self._execute(
+            """
+            SELECT zip_name, cache_key FROM files
+            WHERE processed_at IS NOT NULL AND cache_key IS NOT NULL
+            """
+        )
+        return dict(rows)
+
+    def get_file_flight_dict(self):
+        # 每个zip文件对应航班在航班列表中的信息，没有对应航班的文件不返回
+        rows = self._execute(
+            """
+            SELECT files.zip_name, flights.flight_info FROM files
+            JOIN flights ON files.uid8 = flights.uid8
+            """
+        )
+        return {zip_name: json.loads(flight_info) for zip_name, flight_info in rows}
+
+    def mark_processed(self, zip_name, output_size, uid8=None, cache_key=None):
+        self._execute(
+            """
+            INSERT INTO files (zip_name, uid8, processed_at, output_size, cache_key)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (zip_name) DO UPDATE SET
+                uid8 = COALESCE(excluded.uid8, files.uid8),
+                processed_at = excluded.processed_at,
+                output_size = excluded.output_size,
+                cache_key = excluded.cache_key,
+                error = NULL
+            """,
+            (zip_name, uid8, get_now_str(), output_size, cache_key),
+        )
+
+    def mark_process_error(self, zip_name, error):
+        self._execute(
+            """
+            INSERT INTO files (zip_name, error) VALUES (?, ?)
+            ON CONFLICT (zip_name) DO UPDATE SET error = excluded.error
+            """,
+            (zip_name, error),
+        )
+
+    def mark_archived(self, zip_name_list):
+        now_str = get_now_str()
+        self._executemany(
+            """
+            INSERT INTO files (zip_name, archived_at) VALUES (?, ?)
+            ON CONFLICT (zip_name) DO UPDATE SET archived_at = excluded.archived_at
+            """,
+            ((zip_name, now_str) for zip_name in zip_name_list),
+        )
@@ -1,64 +1,158 @@
+import codecs
 import csv
+import hashlib
+import io
 
 # import glob
-import io
+import operator
 import os
+import struct
 
 # import sys
 import zipfile
 from collections import Counter, defaultdict
 
 # import tqdm
+import numpy as np
 
-from utility import save_dict_data
-
+from profiling import (
+    add_stage_stats,
+    enable_stage_timing,
+    pop_stage_stats,
+    run_with_profile,
+    stage_timer,
+    timed_iter,
+)
+from utility import VAR_DTYPES, get_output_suffix, save_dict_data
 
-# 获取表头初次出现的位置
-def get_index_between(data_list, key_str):
-    index_start = data_list.index(key_str)
-    return index_start
 
+# 处理逻辑改变导致输出结果变化时加1，已有的处理结果和缓存随之失效
+PROCESS_VERSION = 1
 
-# 获取当前参数的采样率
-def get_sample_rate(data_list, key_str):
-    # Counter非常耗时，不要放在较多的循环里
-    sample_rate = Counter(data_list).get(key_str)
 
-    return sample_rate
+# 遍历一次表头，获取每个参数初次出现的位置和采样率
+def gen_slice_plan(data_header, need_vars):
+    first_index = {}
+    for index, header_name in enumerate(data_header):
+        first_index.setdefault(header_name, index)
+    # Counter非常耗时，整个文件只统计一次
+    sample_rates = Counter(data_header)
 
+    slice_plan = {}
+    for search_header in need_vars:
+        if search_header not in first_index:
+            raise ValueError(f"表头中缺少参数{search_header}")
+        slice_plan[search_header] = (
+            first_index[search_header],
+            sample_rates[search_header],
+        )
 
-def gen_vars_dict(data_header, real_data, need_vars):
-    dict_data = defaultdict(lambda: defaultdict(list))
+    return slice_plan
 
-    for search_header in need_vars:
-        sample_rate = get_sample_rate(data_header, search_header)
-        dict_data[f"{search_header}"]["rate"] = sample_rate
 
+def gen_vars_dict(data_header, real_data, need_vars):
+    dict_data = defaultdict(dict)
+    slice_plan = gen_slice_plan(data_header, need_vars)
+
+    # 一次性取出所有需要的列，避免对每一行、每个参数重复切片
+    column_index = [
+        index
+        for index_start, sample_rate in slice_plan.values()
+        for index in range(index_start, index_start + sample_rate)
+    ]
+    get_columns = operator.itemgetter(*column_index)
+    header_length = len(data_header)
+
+    rows = []
     for line in real_data:
-        for search_header in need_vars:
-            index_start = get_index_between(data_header, search_header)
-            index_end = index_start + dict_data[f"{search_header}"]["rate"]
-            list_data = line[index_start:index_end]
-            dict_data[f"{search_header}"]["value"].append(list_data)
+        if len(line) < header_length:
+            # 文件末尾可能被截断，缺失部分按空值处理
+            line = line + [""] * (header_length - len(line))
+        rows.append(get_columns(line))
+    block = np.array(rows, dtype=object).reshape(len(rows), len(column_index))
+
+    column_start = 0
+    for search_header, (_, sample_rate) in slice_plan.items():
+        column_end = column_start + sample_rate
+        dict_data[search_header]["rate"] = sample_rate
+        # 每个参数对应一个连续的(行数, 采样率)二维数组
+        dict_data[search_header]["value"] = block[:, column_start:column_end].astype(
+            str
+        )
+        column_start = column_end
 
     return dict_data
 
 
-def direct_read_zip(file_name):
-    zip_file = zipfile.ZipFile(file_name)
-    file_list = zip_file.namelist()
+# zip内csv文件的单次读取大小，内存占用只与该值有关，与文件大小无关
+ZIP_READ_BUFFER_SIZE = 1024 * 1024
+
+
+def list_inner_zips(file_name):
+    # 下载得到的压缩包中每个zip文件对应一个待处理的csv
+    with zipfile.ZipFile(file_name) as zip_file:
+        name_list = zip_file.namelist()
 
-    with zip_file.open(file_list[0], "r") as f:
-        content = f.read().decode("unicode-escape")
+    return [name for name in name_list if name.lower().endswith(".zip")]
+
+
+def expand_zip_sources(zip_file_s):
+    """
+    未解压的下载压缩包展开为(压缩包路径, 内部zip文件名)，其余zip文件保持原路径
+    """
+    zip_source_s = []
+    for zip_file in zip_file_s:
+        try:
+            inner_zip_list = list_inner_zips(zip_file)
+        except zipfile.BadZipFile:
+            # 损坏的文件交给处理进程报错并记录
+            inner_zip_list = []
 
-    return content
+        if inner_zip_list:
+            zip_source_s.extend((zip_file, name) for name in inner_zip_list)
+        else:
+            zip_source_s.append(zip_file)
+
+    return zip_source_s
+
+
+def open_zip_source(zip_source):
+    if isinstance(zip_source, tuple):
+        # 内部zip文件直接读入内存，不再解压到磁盘
+        archive_name, inner_zip_name = zip_source
+        with zipfile.ZipFile(archive_name) as archive:
+            return zipfile.ZipFile(io.BytesIO(archive.read(inner_zip_name)))
+
+    return zipfile.ZipFile(zip_source)
+
+
+def iter_zip_lines(file_name, buffer_size=ZIP_READ_BUFFER_SIZE):
+    # 分块读取并解码zip内第一个文件，逐行返回，避免整个文件驻留内存
+    decoder = codecs.getincrementaldecoder("unicode-escape")()
+
+    with open_zip_source(file_name) as zip_file:
+        file_list = zip_file.namelist()
+
+        with zip_file.open(file_list[0], "r") as f:
+            tail = ""
+            while chunk := f.read(buffer_size):
+                add_stage_stats("read", nbytes=len(chunk))
+                lines = (tail + decoder.decode(chunk)).split("\n")
+                # 最后一段可能是不完整的行，留到下一块再处理
+                tail = lines.pop()
+                for line in lines:
+                    yield f"{line}\n"
+
+            tail = tail + decoder.decode(b"", final=True)
+            if tail:
+                yield tail
 
 
 def get_csv_header_content(file_name):
-    content = direct_read_zip(file_name)
-    header = csv.DictReader(io.StringIO(content)).fieldnames
-    real_data = csv.reader(io.StringIO(content))
-    for i in range(3):
+    real_data = csv.reader(iter_zip_lines(file_name))
+    # 第一行为表头，随后两行不是数据
+    header = next(real_data, [])
+    for i in range(2):
         next(real_data, None)
 
     return header, real_data
@@ -71,9 +165,31 @@ def get_need_vars_from_csv(file_name: str) -> list:
     return data
 
 
+def get_var_dtypes_from_csv(file_name: str) -> dict:
+    """
+    读取参数数据类型配置，第一行为表头，之后每行为"参数名,类型"，参数名为*的一行为其余参数的默认类型
+    """
+    with open(file_name, "r") as f:
+        rows = list(csv.reader(f, delimiter=","))[1:]
+
+    var_dtypes = {}
+    for row in rows:
+        if not row or not row[0].strip():
+            continue
+        var, dtype = row[0].strip(), row[1].strip().lower()
+        if dtype not in VAR_DTYPES:
+            raise ValueError(f"{var}的数据类型{dtype}不支持，可用的类型为{VAR_DTYPES}")
+        var_dtypes[var] = dtype
+
+    return var_dtypes
+
+
 def get_pure_name_list(file_path_list):
     pure_list = []
     for file_path in file_path_list:
+        if isinstance(file_path, tuple):
+            # 压缩包内的zip文件以内部文件名为准
+            file_path = file_path[1]
         # 获取zipfile的名字
         _, file_name = os.path.split(file_path)
         prefix_file_name = os.path.splitext(file_name)[0]
@@ -82,31 +198,436 @@ def get_pure_name_list(file_path_list):
     return set(pure_list)
 
 
-def process_zip_to_txt(zip_file, txt_file_s, need_vars, output_folder):
+# 生成通道存储时每次转换的行数，内存占用只与该值和文件大小有关
+CHANNEL_STORE_CHUNK_ROWS = 1024
+
+
+def _to_string_block(rows, columns):
+    # 单元格按字节串保存，比unicode数组小4倍；含非ASCII字符时退回unicode
+    try:
+        block = np.array(rows, dtype=bytes)
+    except UnicodeEncodeError:
+        block = np.array(rows, dtype=str)
+
+    return block.reshape(len(rows), columns)
+
+
+def gen_channel_store(zip_file, store_file, store_vars=None):
+    """
+    解析一次zip，把所有参数(或store_vars中的参数)按原始采样率逐个保存到压缩的npz文件，
+    每个参数是一个(行数, 采样率)的字符串数组，读取时只解压需要的参数；返回保存的内容
+    """
+    with stage_timer("read"):
+        header, real_data = get_csv_header_content(zip_file)
+    real_data = timed_iter(real_data, "read")
+
+    # 表头中不存在的参数不保存，读取时按表头不全报错
+    header_names = list(dict.fromkeys(header))
+    if store_vars is None:
+        channels = header_names
+    else:
+        header_name_set = set(header_names)
+        channels = [var for var in dict.fromkeys(store_vars) if var in header_name_set]
+
+    with stage_timer("store"):
+        slice_plan = gen_slice_plan(header, channels)
+        column_index = [
+            index
+            for index_start, sample_rate in slice_plan.values()
+            for index in range(index_start, index_start + sample_rate)
+        ]
+        get_columns = operator.itemgetter(*column_index) if column_index else None
+        header_length = len(header)
+
+        # 分块转换为定长字符串数组，避免所有单元格都以Python字符串驻留内存
+        chunks = []
+        rows = []
+        for line in real_data:
+            if get_columns is None:
+                continue
+            if len(line) < header_length:
+                # 文件末尾可能被截断，缺失部分按空值处理
+                line = line + [""] * (header_length - len(line))
+            rows.append(get_columns(line))
+            if len(rows) == CHANNEL_STORE_CHUNK_ROWS:
+                chunks.append(_to_string_block(rows, len(column_index)))
+                rows = []
+        if rows:
+            chunks.append(_to_string_block(rows, len(column_index)))
+
+        if not chunks:
+            block = np.empty((0, len(column_index)), dtype=bytes)
+        elif any(chunk.dtype.kind == "U" for chunk in chunks):
+            block = np.concatenate([chunk.astype(str) for chunk in chunks])
+        else:
+            block = np.concatenate(chunks)
+
+        store = {
+            "fingerprint": np.asarray(get_zip_fingerprint(zip_file) or ""),
+            # 记录表头中的参数，读取时可以区分未保存的参数和表头中没有的参数
+            "header": np.asarray(header_names, dtype=str),
+            "channels": np.asarray(list(slice_plan), dtype=str),
+            "rates": np.asarray(
+                [sample_rate for _, sample_rate in slice_plan.values()], dtype=int
+            ),
+        }
+        column_start = 0
+        for channel_index, (_, sample_rate) in enumerate(slice_plan.values()):
+            column_end = column_start + sample_rate
+            store[f"channel_{channel_index}"] = block[:, column_start:column_end]
+            column_start = column_end
+
+        # 先写临时文件再改名，多个进程同时处理时不会读到不完整的文件
+        os.makedirs(os.path.dirname(store_file) or ".", exist_ok=True)
+        temp_file = f"{store_file}.{os.getpid()}.tmp"
+        with open(temp_file, "wb") as f:
+            np.savez_compressed(f, **store)
+        os.replace(temp_file, store_file)
+        add_stage_stats("store", nbytes=os.path.getsize(store_file))
+
+    return store
+
+
+def read_channel_store(store, need_vars):
+    """
+    从通道存储中取出need_vars，返回与gen_vars_dict相同结构的dict_data
+    """
+    dict_data = defaultdict(dict)
+    channel_index = {
+        channel: index for index, channel in enumerate(store["channels"].tolist())
+    }
+    rates = store["rates"]
+    for search_header in need_vars:
+        if search_header not in channel_index:
+            raise ValueError(f"表头中缺少参数{search_header}")
+        index = channel_index[search_header]
+        dict_data[search_header]["rate"] = int(rates[index])
+        dict_data[search_header]["value"] = store[f"channel_{index}"].astype(str)
+
+    return dict_data
+
+
+def load_vars_dict_from_store(zip_file, need_vars, store_folder, store_vars=None):
+    """
+    已有对应的通道存储时只读取need_vars，不再解析csv；表头中没有的参数直接报错；
+    存储不存在、zip内容改变或存储中缺少表头中有的需要参数时，重新解析zip并生成存储
+    """
+    zip_file_header = get_pure_name_list([zip_file]).pop()
+    store_file = os.path.join(store_folder, f"{zip_file_header}.npz")
+
+    if os.path.exists(store_file):
+        with stage_timer("read"):
+            try:
+                with np.load(store_file) as store:
+                    # 之前的存储中没有记录表头，重新生成
+                    if "header" in store.files:
+                        stored_channels = set(store["channels"].tolist())
+                        missing_vars = set(need_vars) - stored_channels
+                        if str(store["fingerprint"]) == (
+                            get_zip_fingerprint(zip_file) or ""
+                        ) and not missing_vars & set(store["header"].tolist()):
+                            add_stage_stats("read", nbytes=os.path.getsize(store_file))
+                            return read_channel_store(store, need_vars)
+            except (OSError, KeyError, zipfile.BadZipFile) as e:
+                # 存储损坏时重新生成
+                print(f"{store_file}无法读取，重新生成，具体报错为{e}")
+
+    if store_vars is not None:
+        # 需要的参数总是一并保存
+        store_vars = list(dict.fromkeys([*store_vars, *need_vars]))
+    store = gen_channel_store(zip_file, store_file, store_vars)
+
+    return read_channel_store(store, need_vars)
+
+
+def process_zip_to_txt(
+    zip_file,
+    txt_file_s,
+    need_vars,
+    output_folder,
+    output_format="TSV",
+    store_folder=None,
+    store_vars=None,
+    var_dtypes=None,
+):
     # 获取zipfile的名字
-    _, zip_file_header = os.path.split(zip_file)
-    zip_file_header = os.path.splitext(zip_file_header)[0]
+    zip_file_header = get_pure_name_list([zip_file]).pop()
 
     if zip_file_header not in txt_file_s:
         try:
-            header, real_data = get_csv_header_content(zip_file)
-        except zipfile.BadZipFile as e:
-            print(f'文件{zip_file}损坏，具体报错为{e}')
-            return zip_file_header
-
-        try:
-            dict_data = gen_vars_dict(header, real_data, need_vars=need_vars)
+            if store_folder is None:
+                with stage_timer("read"):
+                    header, real_data = get_csv_header_content(zip_file)
+                # 逐行读取解码的耗时计入read阶段，不计入slice阶段
+                real_data = timed_iter(real_data, "read")
+                with stage_timer("slice"):
+                    dict_data = gen_vars_dict(header, real_data, need_vars=need_vars)
+            else:
+                dict_data = load_vars_dict_from_store(
+                    zip_file, need_vars, store_folder, store_vars
+                )
 
             # 保存处理dict_data到txt文件中
-            txt_file_name = os.path.join(output_folder, f"{zip_file_header}.txt")
-            save_dict_data(dict_data, txt_file_name)
+            output_suffix = get_output_suffix(output_format)
+            txt_file_name = os.path.join(
+                output_folder, f"{zip_file_header}{output_suffix}"
+            )
+            save_dict_data(dict_data, txt_file_name, output_format, var_dtypes)
+        except zipfile.BadZipFile as e:
+            print(f'文件{zip_file}损坏，具体报错为{e}')
+            return zip_file_header, f"文件损坏:{e}"
         except ValueError as e:
             print(f"{zip_file_header}文件表头不全，具体报错为{e}")
+            return zip_file_header, f"文件表头不全:{e}"
     else:
         pass
         # print(f'{zip_file_header}已经处理过，无需重复处理')
 
-    return zip_file_header
+    return zip_file_header, None
+
+
+# 处理进程共用的只读参数，由进程池的initializer在每个进程中设置一次
+_worker_state = {}
+
+
+def init_process_worker(
+    need_vars,
+    output_folder,
+    output_format="TSV",
+    stage_timing=False,
+    profile_name=None,
+    profile_file=None,
+    store_folder=None,
+    store_vars=None,
+    var_dtypes=None,
+):
+    _worker_state["need_vars"] = need_vars
+    _worker_state["output_folder"] = output_folder
+    _worker_state["output_format"] = output_format
+    _worker_state["profile_name"] = profile_name
+    _worker_state["profile_file"] = profile_file
+    _worker_state["store_folder"] = store_folder
+    _worker_state["store_vars"] = store_vars
+    _worker_state["var_dtypes"] = var_dtypes
+    enable_stage_timing(stage_timing)
+
+
+def process_zip_in_worker(zip_file):
+    """
+    返回(文件名, 报错信息, 各阶段统计)，未开启阶段计时时统计为None
+    """
+    # 已在主进程中过滤处理过的文件，这里不再传入txt_file_s
+    args = (
+        zip_file,
+        (),
+        _worker_state["need_vars"],
+        _worker_state["output_folder"],
+        _worker_state["output_format"],
+        _worker_state["store_folder"],
+        _worker_state["store_vars"],
+        _worker_state["var_dtypes"],
+    )
+    if get_pure_name_list([zip_file]).pop() == _worker_state["profile_name"]:
+        zip_file_header, error = run_with_profile(
+            _worker_state["profile_file"], process_zip_to_txt, *args
+        )
+    else:
+        zip_file_header, error = process_zip_to_txt(*args)
+
+    return zip_file_header, error, pop_stage_stats()
+
+
+def get_zip_fingerprint(zip_source):
+    """
+    用zip目录中记录的文件名、CRC32和大小生成内容指纹，无需读取数据；文件损坏时返回None
+    """
+    try:
+        if isinstance(zip_source, tuple):
+            # 压缩包中的zip文件用其在压缩包目录中的记录
+            archive_name, inner_zip_name = zip_source
+            with zipfile.ZipFile(archive_name) as archive:
+                info_list = [archive.getinfo(inner_zip_name)]
+        else:
+            with zipfile.ZipFile(zip_source) as zip_file:
+                info_list = zip_file.infolist()
+    except (zipfile.BadZipFile, OSError, KeyError):
+        return None
+
+    fingerprint = hashlib.sha256()
+    for info in info_list:
+        fingerprint.update(f"{info.filename}:{info.CRC}:{info.file_size};".encode())
+
+    return fingerprint.hexdigest()
+
+
+# 下载压缩包中经过压缩的内层zip无法直接读取其目录，按csv的压缩率估计解压后的大小；
+# EAFR的csv压缩率一般在5～10倍，取偏大的估计，宁可少并行也不超出内存预算
+CSV_COMPRESSION_RATIO = 10
+
+
+class StoredMemberFile(io.RawIOBase):
+    """
+    压缩包中未压缩(ZIP_STORED)成员的只读文件对象，seek直接定位，不读取中间的数据
+    """
+
+    def __init__(self, archive_file, data_start, size):
+        self._archive_file = archive_file
+        self._data_start = data_start
+        self._size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = min(max(offset, 0), self._size)
+        return self._position
+
+    def readinto(self, buffer):
+        read_size = min(len(buffer), self._size - self._position)
+        self._archive_file.seek(self._data_start + self._position)
+        data = self._archive_file.read(read_size)
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def get_stored_zip_csv_size(archive_file, info):
+    # 跳过本地文件头定位到内层zip的数据，只读取内层zip的目录
+    archive_file.seek(info.header_offset)
+    local_header = archive_file.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+    data_start = (
+        info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+    )
+    member_file = StoredMemberFile(archive_file, data_start, info.file_size)
+    with zipfile.ZipFile(member_file) as zip_file:
+        return zip_file.infolist()[0].file_size
+
+
+def get_archive_size_dict(zip_source_s):
+    """
+    估计下载压缩包中每个zip文件里csv解压后的大小，每个压缩包只打开一次，
+    返回{(压缩包, zip文件名): 大小}；未压缩存放的zip读取其目录中csv的大小，
+    经过压缩的zip按CSV_COMPRESSION_RATIO估计
+    """
+    inner_name_dict = defaultdict(set)
+    for zip_source in zip_source_s:
+        if isinstance(zip_source, tuple):
+            inner_name_dict[zip_source[0]].add(zip_source[1])
+
+    archive_size_dict = {}
+    for archive_name, inner_name_set in inner_name_dict.items():
+        try:
+            with zipfile.ZipFile(archive_name) as archive, open(
+                archive_name, "rb"
+            ) as archive_file:
+                for info in archive.infolist():
+                    if info.filename not in inner_name_set:
+                        continue
+                    if info.compress_type == zipfile.ZIP_STORED:
+                        size = get_stored_zip_csv_size(archive_file, info)
+                    else:
+                        size = info.file_size * CSV_COMPRESSION_RATIO
+                    archive_size_dict[(archive_name, info.filename)] = size
+        except (zipfile.BadZipFile, OSError, IndexError, struct.error):
+            # 损坏的压缩包交给处理进程报错，其中的文件按最小文件调度
+            continue
+
+    return archive_size_dict
+
+
+def estimate_zip_source_size(zip_source):
+    # 从zip目录中读取csv解压后的大小，无需解压
+    if isinstance(zip_source, tuple):
+        return get_archive_size_dict([zip_source]).get(zip_source, 0)
+
+    try:
+        with zipfile.ZipFile(zip_source) as zip_file:
+            return zip_file.infolist()[0].file_size
+    except (zipfile.BadZipFile, OSError, IndexError):
+        # 损坏的文件交给处理进程报错，按最小文件调度
+        return 0
+
+
+def sort_zip_sources_by_size(zip_source_s):
+    """
+    返回按解压后大小从大到小排序的(zip文件, 大小)列表，大文件先处理避免最后的长尾
+    """
+    archive_size_dict = get_archive_size_dict(zip_source_s)
+    zip_size_s = [
+        (
+            zip_source,
+            archive_size_dict.get(zip_source, 0)
+            if isinstance(zip_source, tuple)
+            else estimate_zip_source_size(zip_source),
+        )
+        for zip_source in zip_source_s
+    ]
+    zip_size_s.sort(key=lambda zip_size: zip_size[1], reverse=True)
+
+    return zip_size_s
+
+
+def iter_results_within_budget(pool, zip_size_s, jobs, memory_budget, poll=0.05):
+    """
+    按从大到小的顺序分配文件，同时处理的文件解压后总大小不超过memory_budget；
+    放不下最大的文件时用小文件填补空闲进程，但要给最大的文件留出预算，
+    之前开始的文件处理完后它一定能开始，不会被小文件一直挤占；结果按完成顺序返回
+    """
+    waiting = list(zip_size_s)
+    running = []
+    used_size = 0
+    # 最大的文件等待期间开始处理的小文件，它们占用的预算加上最大的文件不超过预算
+    backfill_tasks = []
+    while waiting or running:
+        while len(running) < jobs and waiting:
+            head_size = waiting[0][1]
+            # 没有正在处理的文件时，超过预算的单个文件也要处理
+            if not running or used_size + head_size <= memory_budget:
+                index = 0
+                backfill_tasks = []
+            else:
+                backfill_size = sum(task[1] for task in backfill_tasks)
+                index = next(
+                    (
+                        index
+                        for index, (_, size) in enumerate(waiting[1:], 1)
+                        if used_size + size <= memory_budget
+                        and backfill_size + size + head_size <= memory_budget
+                    ),
+                    None,
+                )
+                if index is None:
+                    break
+
+            zip_source, size = waiting.pop(index)
+            task = (pool.apipe(process_zip_in_worker, zip_source), size)
+            running.append(task)
+            used_size += size
+            if index:
+                backfill_tasks.append(task)
+
+        finished = [task for task in running if task[0].ready()]
+        if not finished:
+            running[0][0].wait(poll)
+            continue
+        for task in finished:
+            running.remove(task)
+            if task in backfill_tasks:
+                backfill_tasks.remove(task)
+            used_size -= task[1]
+            yield task[0].get()
 
 
 if __name__ == "__main__":
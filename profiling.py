@@ -0,0 +1,156 @@
+import cProfile
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# process_zip_to_txt的各个处理阶段，按处理顺序输出
+STAGES = (
+    "read",
+    "store",
+    "slice",
+    "convert",
+    "date",
+    "resample",
+    "dataframe",
+    "save",
+)
+
+# 默认关闭，关闭时计时器不做任何事情
+_enabled = False
+# 当前文件各阶段的[耗时, 字节数]
+_stage_stats = {}
+# 嵌套计时时每层记录子阶段的耗时，保证各阶段耗时互不重叠
+_child_time_stack = []
+
+
+def enable_stage_timing(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def add_stage_stats(stage, seconds=0.0, nbytes=0):
+    if not _enabled:
+        return
+    stats = _stage_stats.setdefault(stage, [0.0, 0])
+    stats[0] += seconds
+    stats[1] += nbytes
+
+
+def pop_stage_stats():
+    # 返回当前文件的统计并清空，供处理进程随结果一起返回主进程
+    if not _enabled:
+        return None
+    stage_stats = {stage: tuple(stats) for stage, stats in _stage_stats.items()}
+    _stage_stats.clear()
+
+    return stage_stats
+
+
+class stage_timer:
+    """
+    统计with语句块的耗时，嵌套的子阶段耗时不计入外层阶段
+    """
+
+    def __init__(self, stage, nbytes=0):
+        self.stage = stage
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        if _enabled:
+            _child_time_stack.append(0.0)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if _enabled:
+            elapsed = time.perf_counter() - self.start
+            child_time = _child_time_stack.pop()
+            add_stage_stats(self.stage, elapsed - child_time, self.nbytes)
+            if _child_time_stack:
+                _child_time_stack[-1] += elapsed
+
+
+def timed_iter(iterable, stage):
+    # 逐项计时，用于把惰性读取的耗时从使用方的阶段中分离出来
+    if not _enabled:
+        return iterable
+
+    return _timed_iter(iter(iterable), stage)
+
+
+def _timed_iter(iterator, stage):
+    end = object()
+    while True:
+        with stage_timer(stage):
+            item = next(iterator, end)
+        if item is end:
+            return
+        yield item
+
+
+def run_with_profile(profile_file, func, *args):
+    # 用cProfile运行单个文件的处理，结果可用snakeviz或pstats查看
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(profile_file)
+        logger.info("cProfile结果已保存到%s", profile_file)
+
+
+def format_stage_report(stage_stats_list):
+    """
+    汇总所有文件的阶段统计，返回各阶段总耗时、占比、单文件耗时分位数和吞吐量的表格
+    """
+    stage_stats_list = [stats for stats in stage_stats_list if stats]
+    if not stage_stats_list:
+        return "没有可汇总的阶段统计"
+
+    stage_names = list(STAGES)
+    for stage_stats in stage_stats_list:
+        for stage in stage_stats:
+            if stage not in stage_names:
+                stage_names.append(stage)
+
+    seconds = np.array(
+        [
+            [stage_stats.get(stage, (0.0, 0))[0] for stage in stage_names]
+            for stage_stats in stage_stats_list
+        ]
+    )
+    nbytes = np.array(
+        [
+            [stage_stats.get(stage, (0.0, 0))[1] for stage in stage_names]
+            for stage_stats in stage_stats_list
+        ]
+    )
+    total_seconds = seconds.sum()
+
+    header = (
+        f"{'stage':<10}{'total(s)':>10}{'share':>8}{'p50(ms)':>10}"
+        f"{'p90(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}{'MB':>10}{'MB/s':>10}"
+    )
+    lines = [f"共{len(stage_stats_list)}个文件", header, "-" * len(header)]
+    rows = [(stage, seconds[:, i], nbytes[:, i]) for i, stage in enumerate(stage_names)]
+    # 总吞吐量按读取的csv大小计算
+    rows.append(("total", seconds.sum(axis=1), nbytes[:, 0]))
+    for stage, stage_seconds, stage_bytes in rows:
+        stage_total = stage_seconds.sum()
+        if stage_total == 0 and stage != "total":
+            continue
+        p50, p90, p99 = np.percentile(stage_seconds, (50, 90, 99)) * 1000
+        mega_bytes = stage_bytes.sum() / 1024 / 1024
+        throughput = mega_bytes / stage_total if mega_bytes and stage_total else 0
+        lines.append(
+            f"{stage:<10}{stage_total:>10.2f}"
+            f"{stage_total / total_seconds if total_seconds else 0:>8.1%}"
+            f"{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}"
+            f"{stage_seconds.max() * 1000:>10.1f}"
+            f"{mega_bytes:>10.1f}{throughput:>10.1f}"
+        )
+
+    return "\n".join(lines)
@@ -0,0 +1,141 @@
+import glob
+import logging
+import os
+import queue
+import threading
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+
+# 发布压缩包支持的压缩算法，均为标准库实现
+RELEASE_COMPRESSIONS = {
+    "DEFLATE": zipfile.ZIP_DEFLATED,
+    "LZMA": zipfile.ZIP_LZMA,
+    "BZIP2": zipfile.ZIP_BZIP2,
+}
+
+
+class ReleaseVolume:
+    def __init__(self, file_path, compression, compresslevel=None):
+        self.file_path = file_path
+        self.zip_file = zipfile.ZipFile(
+            file_path, "w", compression=compression, compresslevel=compresslevel
+        )
+        self.raw_size = 0
+        self.compress_size = 0
+
+    def estimate_size_after(self, file_size):
+        # 按当前分卷已有的压缩比估计再写入一个文件后的大小
+        if self.raw_size == 0:
+            return file_size
+        return self.compress_size + file_size * self.compress_size / self.raw_size
+
+    def write(self, file_path):
+        arcname = os.path.basename(file_path)
+        self.zip_file.write(file_path, arcname=arcname)
+        zip_info = self.zip_file.getinfo(arcname)
+        self.raw_size += zip_info.file_size
+        self.compress_size += zip_info.compress_size
+
+    def close(self):
+        self.zip_file.close()
+
+
+class ReleasePacker:
+    """
+    把输出文件压缩为按大小分卷的zip文件(release_name.001.zip, .002.zip...)，
+    每个分卷都是可以单独解压的完整zip文件；jobs个线程各自写一个分卷，
+    压缩时释放GIL，可以同时压缩；处理过程中每完成一个文件就可以add，无需等待全部完成
+    """
+
+    def __init__(
+        self,
+        release_folder,
+        release_name,
+        volume_size=50 * 1024 * 1024,
+        jobs=4,
+        compression="DEFLATE",
+        compresslevel=None,
+    ):
+        os.makedirs(release_folder, exist_ok=True)
+        self.release_folder = release_folder
+        self.release_name = release_name
+        self.volume_size = volume_size
+        self.compression = RELEASE_COMPRESSIONS[compression.upper()]
+        self.compresslevel = compresslevel
+        # 同一天多次运行时接着已有的最大分卷编号，避免覆盖
+        self._volume_index = max(
+            (
+                int(os.path.basename(file_path).split(".")[-2])
+                for file_path in glob.glob(
+                    os.path.join(release_folder, f"{release_name}.[0-9]*.zip")
+                )
+                if os.path.basename(file_path).split(".")[-2].isdigit()
+            ),
+            default=0,
+        )
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._added = set()
+        self._errors = []
+        self.volume_list = []
+        self._threads = [
+            threading.Thread(target=self._pack_worker, daemon=True)
+            for _ in range(jobs)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _open_volume(self):
+        with self._lock:
+            self._volume_index += 1
+            file_path = os.path.join(
+                self.release_folder,
+                f"{self.release_name}.{self._volume_index:03d}.zip",
+            )
+            self.volume_list.append(file_path)
+
+        return ReleaseVolume(file_path, self.compression, self.compresslevel)
+
+    def _pack_worker(self):
+        volume = None
+        while (file_path := self._queue.get()) is not None:
+            try:
+                file_size = os.path.getsize(file_path)
+                if (
+                    volume is not None
+                    and volume.estimate_size_after(file_size) > self.volume_size
+                ):
+                    volume.close()
+                    volume = None
+                if volume is None:
+                    volume = self._open_volume()
+                volume.write(file_path)
+            except Exception as e:
+                logger.error("%s压缩失败，具体报错为%s", file_path, e)
+                self._errors.append((file_path, e))
+
+        if volume is not None:
+            volume.close()
+
+    def add(self, file_path):
+        if file_path in self._added:
+            return
+        self._added.add(file_path)
+        self._queue.put(file_path)
+
+    def close(self):
+        """
+        等待所有文件压缩完成，返回生成的分卷列表；有文件压缩失败时抛出异常
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        logger.info("共压缩%s个文件，生成分卷：%s", len(self._added), self.volume_list)
+        if self._errors:
+            raise IOError(f"{len(self._errors)}个文件压缩失败: {self._errors}")
+
+        return self.volume_list
@@ -0,0 +1,97 @@
+"""
+process_zip_to_txt与原始实现的结果一致性检查
+
+fixtures中的zip由benchmarks/synthetic_eafr.py生成(30秒，两种时间格式，无空值、无截断，
+原始实现无法处理空值和截断的文件)，同名的.txt.gz为原始实现(首个提交)处理的TSV输出
+"""
+
+import glob
+import gzip
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocess import (
+    get_need_vars_from_csv,
+    get_var_dtypes_from_csv,
+    load_vars_dict_from_store,
+    process_zip_to_txt,
+)
+
+FIXTURE_FOLDER = os.path.join(os.path.dirname(__file__), "fixtures")
+CONFIG_FOLDER = os.path.join(os.path.dirname(__file__), "..", "configs")
+ZIP_FILES = sorted(glob.glob(os.path.join(FIXTURE_FOLDER, "*.zip")))
+
+
+def read_baseline(zip_file):
+    with gzip.open(zip_file.replace(".zip", ".txt.gz"), "rb") as f:
+        return f.read()
+
+
+def process(zip_file, output_folder, **kwargs):
+    need_vars = get_need_vars_from_csv(os.path.join(FIXTURE_FOLDER, "need_vars.csv"))
+    zip_name, error = process_zip_to_txt(
+        zip_file, set(), need_vars, str(output_folder), **kwargs
+    )
+    assert error is None
+    with open(os.path.join(output_folder, f"{zip_name}.txt"), "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("zip_file", ZIP_FILES, ids=os.path.basename)
+def test_default_matches_baseline(zip_file, tmp_path):
+    assert process(zip_file, tmp_path) == read_baseline(zip_file)
+
+
+@pytest.mark.parametrize("zip_file", ZIP_FILES, ids=os.path.basename)
+def test_channel_store_matches_baseline(zip_file, tmp_path):
+    store_folder = tmp_path / "store"
+    # 第一次解析csv并生成通道存储，第二次直接从通道存储读取
+    for run in ("build", "load"):
+        output_folder = tmp_path / run
+        output_folder.mkdir()
+        output = process(zip_file, output_folder, store_folder=str(store_folder))
+        assert output == read_baseline(zip_file)
+    assert len(os.listdir(store_folder)) == 1
+
+
+def test_channel_store_missing_var_fails_without_rebuild(tmp_path):
+    zip_file = ZIP_FILES[0]
+    need_vars = get_need_vars_from_csv(os.path.join(FIXTURE_FOLDER, "need_vars.csv"))
+    # 只保存部分参数的存储中，表头中没有的参数直接报错，不重新解析csv
+    load_vars_dict_from_store(zip_file, need_vars[:2], str(tmp_path), need_vars[:1])
+    store_file = os.path.join(tmp_path, os.listdir(tmp_path)[0])
+    mtime = os.stat(store_file).st_mtime_ns
+    with pytest.raises(ValueError, match="表头中缺少参数"):
+        load_vars_dict_from_store(
+            zip_file, [*need_vars[:2], "Missing_Var"], str(tmp_path), need_vars[:1]
+        )
+    assert os.stat(store_file).st_mtime_ns == mtime
+
+
+@pytest.mark.parametrize("zip_file", ZIP_FILES, ids=os.path.basename)
+def test_compact_dtypes_close_to_baseline(zip_file, tmp_path):
+    var_dtypes = get_var_dtypes_from_csv(os.path.join(CONFIG_FOLDER, "var_dtypes.csv"))
+    output = process(zip_file, tmp_path, var_dtypes=var_dtypes)
+    compact = pd.read_csv(io.BytesIO(output), sep="\t")
+    baseline = pd.read_csv(io.BytesIO(read_baseline(zip_file)), sep="\t")
+
+    assert list(compact.columns) == list(baseline.columns)
+    assert (compact["DATE"] == baseline["DATE"]).all()
+    for column in compact.columns:
+        # COG由保持上一个值的重心各位数字计算，与线性插值的结果不可比
+        if column in ("DATE", "COG"):
+            continue
+        dtype = np.dtype(var_dtypes.get(column, var_dtypes["*"]))
+        if dtype.kind == "f":
+            np.testing.assert_allclose(
+                compact[column], baseline[column], rtol=1e-5, atol=1e-4
+            )
+        else:
+            # 整数参数不插值，每秒的第一行(所有采样率的采样点)与四舍五入的结果一致
+            np.testing.assert_array_equal(
+                compact[column][::16], np.rint(baseline[column][::16])
+            )
@@ -1,221 +1,571 @@
 import datetime
+import io
 import logging
 import os
-import re
-import time
 import zipfile
+from collections import defaultdict
 
 import numpy as np
 import pandas as pd
-from scipy import interpolate
+
+from profiling import add_stage_stats, stage_timer
 
 logger = logging.getLogger(__name__)
 
 
-def interp_low_rate_data(data_list, ini_rate, desti_rate):
-    sub_list_numbers = len(data_list)
-    whole_data_numbers = sub_list_numbers * ini_rate
+def gen_resample_grid(sample_numbers, ini_rate, desti_rate):
+    # 同一采样率、同样长度的参数共用一套插值网格，只需计算一次
+    if sample_numbers < 2:
+        raise ValueError(f"插值至少需要2个数据点，当前只有{sample_numbers}个")
+
     x_step = 100 / ini_rate
-    x_stop = x_step * (whole_data_numbers - 1)
+    x_stop = x_step * (sample_numbers - 1)
     resample_rate = int(desti_rate / ini_rate)
 
-    var_y = data_list.flatten()
-    var_x = np.linspace(0, x_stop, num=whole_data_numbers)
+    var_x = np.linspace(0, x_stop, num=sample_numbers)
     new_x = np.linspace(
         0,
         x_stop + x_step * (1 - ini_rate / desti_rate),
-        num=whole_data_numbers * resample_rate,
+        num=sample_numbers * resample_rate,
     )
-    inter_func = interpolate.interp1d(
-        var_x, var_y, kind="linear", fill_value="extrapolate"
-    )
-    new_y = inter_func(new_x)
+    # 与interp1d(kind="linear", fill_value="extrapolate")的取点方式一致，
+    # 超出末端的点沿最后一段直线外推
+    index_hi = np.searchsorted(var_x, new_x).clip(1, sample_numbers - 1)
+    index_lo = index_hi - 1
+    x_lo = var_x[index_lo]
+
+    return index_lo, index_hi, var_x[index_hi] - x_lo, new_x - x_lo
+
+
+def interp_linear(var_y, resample_grid):
+    # var_y为(数据点数, 参数个数)的二维数组，所有参数一次插值完成
+    index_lo, index_hi, x_gap, x_offset = resample_grid
+    y_lo = var_y[index_lo]
+    slope = (var_y[index_hi] - y_lo) / x_gap[:, None]
+
+    return slope * x_offset[:, None] + y_lo
+
+
+def interp_low_rate_data(data_list, ini_rate, desti_rate):
+    whole_data_numbers = len(data_list) * ini_rate
+    resample_grid = gen_resample_grid(whole_data_numbers, ini_rate, desti_rate)
+    var_y = np.asarray(data_list, dtype=np.float64).reshape(whole_data_numbers, 1)
+
+    return interp_linear(var_y, resample_grid)[:, 0]
+
+
+def resample_channels(channel_data, channel_rates, desti_rate=16):
+    resampled_data = {}
+    rate_groups = defaultdict(list)
+    for key, value_list in channel_data.items():
+        value_rate = channel_rates[key]
+        if value_rate < desti_rate:
+            rate_groups[(value_rate, len(value_list), value_list.dtype)].append(key)
+        elif value_rate == desti_rate:
+            resampled_data[key] = value_list.flatten()
+        else:
+            # 高于输出采样率的参数直接抽取
+            resampled_data[key] = value_list.flatten()[:: value_rate // desti_rate]
+
+    for (value_rate, sub_list_numbers, dtype), keys in rate_groups.items():
+        whole_data_numbers = sub_list_numbers * value_rate
+        if dtype.kind in "iu":
+            # 离散参数不做线性插值，每个值保持到下一个采样点
+            resample_rate = int(desti_rate / value_rate)
+            for key in keys:
+                resampled_data[key] = np.repeat(
+                    channel_data[key].reshape(whole_data_numbers), resample_rate
+                )
+            continue
+
+        resample_grid = gen_resample_grid(whole_data_numbers, value_rate, desti_rate)
+        # 同组参数按其类型插值，float32参数的插值缓冲区也只占一半内存
+        var_y = np.empty(
+            (whole_data_numbers, len(keys)),
+            dtype=dtype if dtype.kind == "f" else np.float64,
+        )
+        for column, key in enumerate(keys):
+            var_y[:, column] = channel_data[key].reshape(whole_data_numbers)
+
+        new_y = interp_linear(var_y, resample_grid)
+        for column, key in enumerate(keys):
+            resampled_data[key] = new_y[:, column].astype(var_y.dtype, copy=False)
+
+    # 保持与输入一致的参数顺序
+    return {key: resampled_data[key] for key in channel_data}
+
+
+def fill_missing_values(float_data):
+    # 与pd.Series.interpolate().bfill()一致：中间缺失线性插值，
+    # 末尾缺失用最后一个有效值补齐，开头缺失用第一个有效值补齐
+    flat_data = float_data.ravel()
+    valid = ~np.isnan(flat_data)
+    if not valid.any():
+        return float_data
+
+    index = np.arange(flat_data.size)
+    filled_data = np.interp(index, index[valid], flat_data[valid])
+
+    return filled_data.reshape(float_data.shape)
 
-    return new_y
+
+def trans_str_to_array(str_data):
+    # 空字符串视为缺失值
+    str_data = np.asarray(str_data)
+    if str_data.dtype.kind in "biuf":
+        return str_data.astype(float)
+
+    str_data = str_data.astype(str)
+    missing = str_data == ""
+    float_data = np.full(str_data.shape, np.nan)
+    if missing.all():
+        return float_data
+
+    try:
+        float_data[~missing] = str_data[~missing].astype(float)
+    except ValueError as e:
+        logger.info(
+            "遇到了无法直接转换为Float的数据格式，可能是时间格式，具体见报错:%s", e
+        )
+        return str_data
+
+    if missing.any():
+        float_data = fill_missing_values(float_data)
+
+    return float_data
 
 
 def trans_json_to_array(json_data):
-    if "" in (str_list := json_data.values()):
-        temp_list = []
-        for str_value in str_list:
-            if str_value == "":
-                float_value = np.nan
-            else:
-                float_value = float(str_value)
-
-            temp_list.append(float_value)
-
-        temp_pd = pd.Series(temp_list)
-        temp_np = temp_pd.interpolate().bfill().to_numpy()
-        return temp_np
-    else:
-        try:
-            return np.asarray(list(json_data.values())).astype(float)
-        except ValueError as e:
-            logger.info(
-                "遇到了无法直接转换为Float的数据格式，可能是时间格式，具体见报错:%s", e
+    return trans_str_to_array(list(json_data.values()))
+
+
+# 参数数据类型配置中可以使用的类型，离散参数使用整数类型
+VAR_DTYPES = ("float64", "float32", "int8", "int16", "int32", "uint8", "uint16")
+
+
+def get_var_dtype(key, var_dtypes=None):
+    # 没有配置时保持float64，*为其余参数的默认类型
+    if not var_dtypes:
+        return np.dtype(np.float64)
+
+    return np.dtype(var_dtypes.get(key, var_dtypes.get("*", "float64")))
+
+
+def cast_channel(key, value_list, var_dtypes=None):
+    """
+    按参数数据类型配置转换参数；离散参数四舍五入为整数，超出取值范围的截断并记录；
+    仍有缺失值时整数类型无法表示，保持为float32；字符串等非数值参数保持不变
+    """
+    value_list = np.asarray(value_list)
+    if value_list.dtype.kind not in "biuf":
+        return value_list
+
+    dtype = get_var_dtype(key, var_dtypes)
+    if dtype.kind in "iu" and value_list.dtype.kind == "f":
+        if np.isnan(value_list).any():
+            logger.info("%s存在缺失值，无法保存为%s，保持为float32", key, dtype)
+            return value_list.astype(np.float32, copy=False)
+
+        dtype_info = np.iinfo(dtype)
+        value_list = np.rint(value_list)
+        out_of_range = (value_list < dtype_info.min) | (value_list > dtype_info.max)
+        if out_of_range.any():
+            logger.warning(
+                "%s有%s个值超出%s的取值范围，截断为[%s, %s]",
+                key,
+                np.count_nonzero(out_of_range),
+                dtype,
+                dtype_info.min,
+                dtype_info.max,
             )
-            return np.asarray(list(json_data.values()))
+            value_list = value_list.clip(dtype_info.min, dtype_info.max)
 
+    return value_list.astype(dtype, copy=False)
 
-def trans_date_to_timestamp(date_data):
-    try:
-        timstamp = time.mktime(time.strptime(date_data, "%Y-%m-%d %H:%M:%S"))
-    except Exception as e:
-        logger.info("可能是时间格式不对，尝试用另一种时间读取格式，具体报错如下:%s", e)
-        timstamp = time.mktime(time.strptime(date_data, "%Y/%m/%d %H:%M:%S"))
 
-    return timstamp
+# DATE参数可能出现的时间格式
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S")
+
+
+def detect_date_format(date_str):
+    for date_format in DATE_FORMATS:
+        try:
+            datetime.datetime.strptime(date_str, date_format)
+        except ValueError:
+            continue
+        return date_format
+
+    raise ValueError(f"无法识别的时间格式:{date_str}")
+
+
+def trans_date_to_nanoseconds(date_data):
+    # 每个文件只判断一次时间格式，然后整体解析
+    date_data = np.asarray(date_data)
+    date_format = detect_date_format(str(date_data.flat[0]))
+    date_index = pd.to_datetime(date_data.ravel(), format=date_format)
+    if date_index.hasnans:
+        raise ValueError("DATE参数存在空值")
+
+    return date_index.as_unit("ns").asi8.reshape(date_data.shape)
+
+
+def trans_nanoseconds_to_date(date_ns):
+    # 先四舍五入到微秒再截断到毫秒，格式为%H:%M:%S:%f[:-3]
+    date_ms = (date_ns + 500) // 1000 // 1000
+    date_str = np.datetime_as_string(date_ms.astype("datetime64[ms]"))
+    # YYYY-MM-DDTHH:MM:SS.mmm -> HH:MM:SS:mmm
+    date_char = date_str.astype("<U23").view("<U1").reshape(-1, 23)[:, 11:]
+    date_char[:, 8] = ":"
+
+    return np.ascontiguousarray(date_char).view("<U12").ravel()
 
 
-def trans_timestamp_to_date(timestamp):
-    datetime_type = datetime.datetime.fromtimestamp(timestamp)
-    return datetime_type.strftime("%H:%M:%S:%f")[:-3]
+def trans_date_list(date_data, date_rate, desti_rate=16, output_format="TSV"):
+    date_ns = trans_date_to_nanoseconds(date_data)
+
+    # 以首个时刻为基准在整数纳秒上插值，避免大数浮点误差
+    start_ns = date_ns.flat[0]
+    offset_ns = interp_low_rate_data(date_ns - start_ns, date_rate, desti_rate)
+    date_ns = start_ns + np.rint(offset_ns).astype(np.int64)
+
+    if output_format.upper() == "TSV":
+        return trans_nanoseconds_to_date(date_ns)
+
+    # 二进制格式保留真实的时间类型
+    return date_ns.astype("datetime64[ns]")
+
+
+# 读取输出文件时DATE统一转换为的类型
+DATE_DTYPE = "<M8[ns]"
+
+
+def trans_output_dates(date_values, flight_date=None):
+    """
+    输出文件中的DATE转换为datetime64[ns]；TSV中只有时:分:秒:毫秒，
+    结合航班日期得到完整时间，跨过零点后日期加一天
+    """
+    date_values = np.asarray(date_values)
+    if np.issubdtype(date_values.dtype, np.datetime64):
+        return date_values.astype(DATE_DTYPE)
+
+    # HH:MM:SS:mmm -> HH:MM:SS.mmm
+    time_str = pd.Series(date_values).str.replace(r":(\d{3})$", r".\1", regex=True)
+    time_ns = pd.to_timedelta(time_str).to_numpy(dtype="m8[ns]").astype(np.int64)
+    day_ns = 24 * 3600 * 10**9
+    # 只有回退超过半天才是跨过零点，时间的小幅回退(记录错误)不改变日期
+    midnight_wrap = np.diff(time_ns) < -day_ns // 2
+    day_offset = np.concatenate([[0], np.cumsum(midnight_wrap)]) * day_ns
+    start_date = np.datetime64(flight_date or "1970-01-01", "ns")
+
+    return start_date + (time_ns + day_offset).astype("timedelta64[ns]")
 
 
 def lbs_to_kg(gross_weight):
     return 0.4536 * gross_weight
 
 
-def add_cog_percent(dataframe: pd.DataFrame):
+def add_cog_percent(channel_data: dict):
     # CG1_0_01_R,CG1_0_1_R,CG1_100_R,CG1_10_R,CG1_1_R
-    cog_0_01 = dataframe.pop("CG1_0_01_R")
-    cog_0_1 = dataframe.pop("CG1_0_1_R")
-    cog_1 = dataframe.pop("CG1_1_R")
-    cog_10 = dataframe.pop("CG1_10_R")
-    cog_100 = dataframe.pop("CG1_100_R")
+    # 各位数字可能按整数类型保存，先转为浮点数再计算，避免整数溢出
+    cog_0_01 = channel_data.pop("CG1_0_01_R").astype(np.float64, copy=False)
+    cog_0_1 = channel_data.pop("CG1_0_1_R").astype(np.float64, copy=False)
+    cog_1 = channel_data.pop("CG1_1_R").astype(np.float64, copy=False)
+    cog_10 = channel_data.pop("CG1_10_R").astype(np.float64, copy=False)
+    cog_100 = channel_data.pop("CG1_100_R").astype(np.float64, copy=False)
 
     cog = 0.01 * cog_0_01 + 0.1 * cog_0_1 + cog_1 + 10 * cog_10 + 100 * cog_100
 
-    dataframe.insert(loc=0, column="COG", value=cog)
+    channel_data["COG"] = cog
+
+    return channel_data
+
+
+def fit_length(key, value_list, target_length):
+    value_length = len(value_list)
+    if value_length < target_length and value_list.dtype.kind in "iu":
+        # 整数类型没有NaN，离散参数用最后一个值补齐
+        logger.info(
+            "%s数据长度为%s，短于时间长度%s，默认为后段数据丢失用最后一个值补齐",
+            key,
+            value_length,
+            target_length,
+        )
+        value_list = np.pad(
+            value_list,
+            (0, target_length - value_length),
+            "edge" if value_length else "constant",
+        )
+    elif value_length < target_length:
+        logger.info(
+            "%s数据长度为%s，短于时间长度%s，默认为后段数据丢失直接用NaN进行补齐",
+            key,
+            value_length,
+            target_length,
+        )
+        value_list = np.pad(
+            value_list,
+            (0, target_length - value_length),
+            "constant",
+            constant_values=(np.nan, np.nan),
+        )
+    elif value_length > target_length:
+        logger.info(
+            "%s数据长度为%s，长于时间长度%s，截断多余数据",
+            key,
+            value_length,
+            target_length,
+        )
+        value_list = value_list[:target_length]
+
+    return value_list
+
+
+def gen_output_dataframe(date_list, channel_data, var_dtypes=None):
+    # 以DATE的长度为准，先统一所有参数长度，再计算衍生参数
+    target_length = len(date_list)
+    channel_data = {
+        key: fit_length(key, value_list, target_length)
+        for key, value_list in channel_data.items()
+    }
+
+    channel_data = add_cog_percent(channel_data)
+    channel_data["GrossWt_R"] = lbs_to_kg(channel_data["GrossWt_R"])
+    if var_dtypes:
+        # 衍生参数同样按配置的类型输出
+        channel_data = {
+            key: cast_channel(key, value_list, var_dtypes)
+            for key, value_list in channel_data.items()
+        }
+
+    # DATE在第一列，其余参数按名称排序，一次性生成DataFrame
+    frame_data = {"DATE": date_list}
+    for key in sorted(channel_data):
+        frame_data[key] = channel_data[key]
+
+    return pd.DataFrame(frame_data)
+
+
+# 支持的输出格式及对应的文件后缀
+OUTPUT_FORMATS = {
+    "TSV": ".txt",
+    "PARQUET": ".parquet",
+    "FEATHER": ".feather",
+    "NPZ": ".npz",
+}
+
+
+def get_output_suffix(output_format):
+    return OUTPUT_FORMATS[output_format.upper()]
+
+
+def save_dataframe(dataframe, file_path, output_format="TSV", sample_rate=16):
+    output_format = output_format.upper()
+
+    if output_format == "TSV":
+        dataframe.to_csv(file_path, sep="\t", index=False)
+    elif output_format in ("PARQUET", "FEATHER"):
+        try:
+            import pyarrow as pa
+            from pyarrow import feather, parquet
+        except ImportError as e:
+            raise ImportError(
+                f"输出{output_format}格式需要安装pyarrow: uv sync --extra columnar"
+            ) from e
+
+        table = pa.Table.from_pandas(dataframe, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b"sample_rate"] = str(sample_rate).encode()
+        table = table.replace_schema_metadata(metadata)
+        if output_format == "PARQUET":
+            parquet.write_table(table, file_path, compression="zstd")
+        else:
+            feather.write_feather(table, file_path, compression="zstd")
+    elif output_format == "NPZ":
+        # 参数名可能与保留字段重名，因此列名单独存储，数据按列序号存储
+        columns = {
+            f"column_{index}": dataframe[column].to_numpy()
+            for index, column in enumerate(dataframe.columns)
+        }
+        with open(file_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                columns=np.asarray(dataframe.columns, dtype=str),
+                sample_rate=np.int64(sample_rate),
+                **columns,
+            )
+    else:
+        raise ValueError(f"不支持的输出格式{output_format}")
+
+
+def get_output_format(file_path):
+    # 按后缀判断输出文件的格式，不是输出文件时返回None
+    suffix = os.path.splitext(file_path)[1].lower()
+    for output_format, output_suffix in OUTPUT_FORMATS.items():
+        if suffix == output_suffix:
+            return output_format
+
+    return None
+
+
+def load_dataframe(
+    file_path, output_format="TSV", columns=None, row_start=0, row_count=None
+):
+    """
+    读取save_dataframe保存的文件，columns不为None时只读取其中的列，
+    row_start和row_count选择其中连续的行；file_path也可以是文件对象
+    """
+    output_format = output_format.upper()
+    row_end = None if row_count is None else row_start + row_count
+
+    if output_format == "TSV":
+        # DATE为时:分:秒:毫秒字符串，不做类型推断；选择的行之后不再解析
+        return pd.read_csv(
+            file_path,
+            sep="\t",
+            usecols=columns,
+            dtype={"DATE": str},
+            skiprows=range(1, row_start + 1) if row_start else None,
+            nrows=row_count,
+        )
+    elif output_format in ("PARQUET", "FEATHER"):
+        try:
+            from pyarrow import feather, parquet
+        except ImportError as e:
+            raise ImportError(
+                f"读取{output_format}格式需要安装pyarrow: uv sync --extra columnar"
+            ) from e
+
+        if output_format == "PARQUET":
+            table = parquet.read_table(file_path, columns=columns)
+        else:
+            table = feather.read_table(file_path, columns=columns)
+        return table.slice(row_start, row_count).to_pandas()
+    elif output_format == "NPZ":
+        with np.load(file_path) as npz_file:
+            all_columns = npz_file["columns"].tolist()
+            if columns is None:
+                columns = all_columns
+            missing_columns = set(columns) - set(all_columns)
+            if missing_columns:
+                raise ValueError(f"文件中缺少参数{sorted(missing_columns)}")
+            # 与其他格式一致，按文件中的列顺序返回
+            column_set = set(columns)
+            return pd.DataFrame(
+                {
+                    column: npz_file[f"column_{index}"][row_start:row_end]
+                    for index, column in enumerate(all_columns)
+                    if column in column_set
+                }
+            )
+    else:
+        raise ValueError(f"不支持的输出格式{output_format}")
+
+
+def list_output_files(input_path_s):
+    """
+    展开输出文件夹、单个输出文件和Release分卷，
+    返回(zip文件名, 输出格式, 文件路径, 分卷中的文件名)列表，只读取zip目录
+    """
+    output_file_s = []
+    for input_path in input_path_s:
+        if os.path.isdir(input_path):
+            file_path_s = sorted(
+                os.path.join(input_path, name) for name in os.listdir(input_path)
+            )
+        else:
+            file_path_s = [input_path]
+
+        for file_path in file_path_s:
+            output_format = get_output_format(file_path)
+            if output_format is not None:
+                zip_name = os.path.splitext(os.path.basename(file_path))[0]
+                output_file_s.append((zip_name, output_format, file_path, None))
+            elif zipfile.is_zipfile(file_path):
+                with zipfile.ZipFile(file_path) as volume:
+                    name_list = volume.namelist()
+                for name in name_list:
+                    output_format = get_output_format(name)
+                    if output_format is None:
+                        continue
+                    zip_name = os.path.splitext(os.path.basename(name))[0]
+                    output_file_s.append((zip_name, output_format, file_path, name))
 
-    return dataframe
+    return output_file_s
+
+
+def open_output_file(file_path, member_name=None):
+    # Release分卷中的输出文件读入内存，不解压到磁盘
+    if member_name is None:
+        return file_path
+
+    with zipfile.ZipFile(file_path) as volume:
+        return io.BytesIO(volume.read(member_name))
 
 
 def extract_zip(file_name, dir_name, delete_origin=True):
     with zipfile.ZipFile(file_name, "r") as zip_file:
         zip_file.extractall(dir_name)
+        name_list = zip_file.namelist()
     if delete_origin:
         os.remove(file_name)
 
+    return name_list
 
-def save_json_date(json_data, file_path):
-    json_dataframe = pd.DataFrame()
+
+def save_json_date(json_data, file_path, output_format="TSV", var_dtypes=None):
+    channel_data = {}
+    channel_rates = {}
 
     for key, value in json_data.items():
         if key == "DATE":
             date_rate = value["rate"]
             date_data = trans_json_to_array(value["value"])
-
-            timestamp_func = np.vectorize(trans_date_to_timestamp)
-            date_func = np.vectorize(trans_timestamp_to_date)
-
-            timestamp_list = timestamp_func(date_data)
-            date_list = interp_low_rate_data(timestamp_list, date_rate, 16)
-            date_list = date_func(date_list)
+            date_list = trans_date_list(
+                date_data, date_rate, output_format=output_format
+            )
         else:
-            value_rate = value["rate"]
-            if value_rate < 16:
-                value_list = trans_json_to_array(value["value"])
-                value_list = interp_low_rate_data(value_list, value_rate, 16)
-            elif value_rate == 16:
-                value_list = trans_json_to_array(json_data[key]["value"]).flatten()
-
-            try:
-                json_dataframe[key] = value_list
-            except ValueError as e:
-                logger.info(
-                    "可能出现罕见的部分时间段数据缺失错误，程序报错为%s\n将默认为后段数据丢失直接用NaN进行补齐",
-                    e,
-                )
-                index_result = re.findall(r"\((\d*?)\)", repr(e))
-                larger_range = int(index_result[1])
-                little_range = int(index_result[0])
-                value_list = np.pad(
-                    value_list,
-                    (0, larger_range - little_range),
-                    "constant",
-                    constant_values=(np.nan, np.nan),
-                )
-                json_dataframe[key] = value_list
-
-    json_dataframe = add_cog_percent(json_dataframe)
-    json_dataframe["GrossWt_R"] = lbs_to_kg(json_dataframe["GrossWt_R"])
+            channel_data[key] = cast_channel(
+                key, trans_json_to_array(value["value"]), var_dtypes
+            )
+            channel_rates[key] = value["rate"]
 
-    mid_json_dataframe = json_dataframe.sort_index(axis=1)
-    mid_json_dataframe.insert(loc=0, column="DATE", value=date_list)
+    # 按采样率分组，同组参数一次完成插值
+    channel_data = resample_channels(channel_data, channel_rates, 16)
 
-    mid_json_dataframe.to_csv(file_path, sep="\t", index=False)
+    output_dataframe = gen_output_dataframe(date_list, channel_data, var_dtypes)
+    save_dataframe(output_dataframe, file_path, output_format)
 
 
 def trans_list_to_array(list_data):
-    if [""] in list_data:
-        temp_list = []
-        for str_value in list_data:
-            if str_value == [""]:
-                float_value = np.nan
-            else:
-                float_value = float(str_value[0])
-
-            temp_list.append(float_value)
-
-        temp_pd = pd.Series(temp_list)
-        temp_np = temp_pd.interpolate().bfill().to_numpy()
-        return temp_np
-    else:
-        try:
-            return np.asarray(list_data).astype(float)
-        except ValueError as e:
-            logger.info(
-                "遇到了无法直接转换为Float的数据格式，可能是时间格式，具体见报错%s", e
-            )
-            return np.asarray(list_data)
+    # list_data为gen_vars_dict生成的(行数, 采样率)二维字符串数组
+    return trans_str_to_array(list_data)
 
 
-def save_dict_data(dict_data, file_path):
-    json_dataframe = pd.DataFrame()
+def save_dict_data(dict_data, file_path, output_format="TSV", var_dtypes=None):
+    channel_data = {}
+    channel_rates = {}
 
     for key, value in dict_data.items():
         if key == "DATE":
             date_rate = value["rate"]
-            date_data = trans_list_to_array(value["value"])
-
-            timestamp_func = np.vectorize(trans_date_to_timestamp)
-            date_func = np.vectorize(trans_timestamp_to_date)
-
-            timestamp_list = timestamp_func(date_data)
-            date_list = interp_low_rate_data(timestamp_list, date_rate, 16)
-            date_list = date_func(date_list)
-        else:
-            value_rate = value["rate"]
-            if value_rate < 16:
-                value_list = trans_list_to_array(value["value"])
-                value_list = interp_low_rate_data(value_list, value_rate, 16)
-            elif value_rate == 16:
-                value_list = trans_list_to_array(dict_data[key]["value"]).flatten()
-
-            try:
-                json_dataframe[key] = value_list
-            except ValueError as e:
-                logger.info(
-                    "可能出现罕见的部分时间段数据缺失错误，程序报错为%s\n将默认为后段数据丢失直接用NaN进行补齐",
-                    e,
+            with stage_timer("date"):
+                date_list = trans_date_list(
+                    value["value"], date_rate, output_format=output_format
                 )
-                index_result = re.findall(r"\((\d*?)\)", repr(e))
-                larger_range = int(index_result[1])
-                little_range = int(index_result[0])
-                value_list = np.pad(
-                    value_list,
-                    (0, larger_range - little_range),
-                    "constant",
-                    constant_values=(np.nan, np.nan),
+        else:
+            with stage_timer("convert"):
+                # 转换后立即按配置的类型保存，之后的插值和输出都使用该类型
+                channel_data[key] = cast_channel(
+                    key, trans_list_to_array(value["value"]), var_dtypes
                 )
-                json_dataframe[key] = value_list
-
-    json_dataframe = add_cog_percent(json_dataframe)
-    json_dataframe["GrossWt_R"] = lbs_to_kg(json_dataframe["GrossWt_R"])
+            channel_rates[key] = value["rate"]
 
-    mid_json_dataframe = json_dataframe.sort_index(axis=1)
-    mid_json_dataframe.insert(loc=0, column="DATE", value=date_list)
+    # 按采样率分组，同组参数一次完成插值
+    with stage_timer("resample"):
+        channel_data = resample_channels(channel_data, channel_rates, 16)
 
-    mid_json_dataframe.to_csv(file_path, sep="\t", index=False)
+    with stage_timer("dataframe"):
+        output_dataframe = gen_output_dataframe(date_list, channel_data, var_dtypes)
+    with stage_timer("save"):
+        save_dataframe(output_dataframe, file_path, output_format)
+    add_stage_stats("save", nbytes=os.path.getsize(file_path))